@@ -0,0 +1,211 @@
+'''
+Load benchmark of the whole bridge against simulated devices, through a local MQTT broker.
+
+    python3 benchmark.py --am43 30 --fingerbot 5 --commands 200 --rate 10
+
+Reports latency percentiles from MQTT command to device write (dispatch) and to the resulting state (complete),
+connection churn as seen by the simulated radio, and process CPU time per command (bridge, broker and driver together).
+'''
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+
+import amqtt.broker
+import amqtt.client
+import amqtt.mqtt.constants
+
+import main
+import simulation
+from device.am43 import AM43
+
+LOCAL_KEY = 'benchmark'
+
+
+def percentiles(values: list[float]):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {f'p{q}': values[min(len(values) - 1, int(len(values) * q / 100))] for q in (50, 90, 99)} | {'max': values[-1]}
+
+
+def create_devices(args, sim: simulation.Simulation):
+    devices = {}
+    for index in range(args.am43):
+        address = f'AA:00:00:00:{index >> 8:02X}:{index & 0xff:02X}'
+        sim.add(simulation.VirtualAM43(address, speed=args.speed, latency=args.latency))
+        devices[address] = {'type': 'am43'}
+    for index in range(args.fingerbot):
+        address = f'BB:00:00:00:{index >> 8:02X}:{index & 0xff:02X}'
+        sim.add(simulation.VirtualFingerBot(address, local_key=LOCAL_KEY, idle_timeout=args.idle_timeout, latency=args.latency))
+        devices[address] = {'type': 'tuya.fingerbot', 'device_id': 'benchmark', 'uuid': 'tuyabenchmark', 'local_key': LOCAL_KEY}
+    return devices
+
+
+def get_identifier(address: str, device_type: str):
+    prefix = 'am43' if device_type == 'am43' else 'tuya_fingerbot'
+    return f'{prefix}_{address.replace(":", "").lower()}'
+
+
+async def benchmark(args):
+    sim = simulation.Simulation(
+        connect_delay=args.connect_delay,
+        disconnect_delay=args.disconnect_delay,
+        abort_rate=args.abort_rate,
+        not_found_rate=args.not_found_rate,
+        write_error_rate=args.write_error_rate,
+        mtu=args.mtu,
+        seed=args.seed,
+    )
+    devices = create_devices(args, sim)
+    base_topic = 'ble2mqtt_benchmark'
+    server = args.server or f'mqtt://127.0.0.1:{args.port}'
+    configuration = {
+        'mqtt': {'base_topic': base_topic, 'server': server, 'client_id': 'ble2mqtt_benchmark_bridge', 'discovery_cache': None},
+        'controller': {'capacity': args.capacity, 'report_interval': 3600, 'scanner': False, 'snapshot': None},
+        'devices': devices,
+        'trace': {'path': args.trace} if args.trace else None,
+    }
+    broker = None
+    if not args.server:
+        broker = amqtt.broker.Broker({
+            'listeners': {'default': {'type': 'tcp', 'bind': f'127.0.0.1:{args.port}'}},
+            'plugins': {'amqtt.plugins.authentication.AnonymousAuthPlugin': {'allow_anonymous': True}},
+        })
+        await broker.start()
+
+    driver = amqtt.client.MQTTClient(client_id='ble2mqtt_benchmark_driver')
+    await driver.connect(server)
+    await driver.subscribe([(f'{base_topic}/#', amqtt.mqtt.constants.QOS_0)])
+    online: set[str] = set()
+    ready = asyncio.Event()
+    waiting: dict[str, tuple[int, asyncio.Future]] = {}
+    received: collections.Counter[str] = collections.Counter()
+
+    async def receive():
+        while True:
+            message = await driver.deliver_message()
+            _, identifier, *topic = message.topic.split('/')
+            data = message.data.decode('utf8')
+            received['state' if not topic else topic[0]] += 1
+            if topic == ['availability'] and data == 'online':
+                online.add(identifier)
+                if len(online) == len(devices):
+                    ready.set()
+            elif not topic and identifier in waiting:
+                target, future = waiting[identifier]
+                if json.loads(data).get('position') == target and not future.done():
+                    future.set_result(time.monotonic())
+
+    receiver = asyncio.create_task(receive())
+    startup = time.monotonic()
+    bridge = asyncio.create_task(main.serve(configuration, backend=sim.backend))
+    await asyncio.wait_for(ready.wait(), args.timeout * 10)
+    startup = time.monotonic() - startup
+
+    rng = random.Random(args.seed)
+    identifiers = {get_identifier(address, config['type']): address for address, config in devices.items()}
+    idle = set(identifiers)
+    released = asyncio.Condition()
+    results = collections.defaultdict(list)
+    timeouts = collections.Counter()
+    sim.stats.clear()
+    received.clear()
+    cpu = time.process_time()
+
+    async def command(identifier: str):
+        peripheral = sim.peripherals[identifiers[identifier]]
+        dispatched = asyncio.get_running_loop().create_future()
+
+        def dispatch(*_):
+            if not dispatched.done():
+                dispatched.set_result(time.monotonic())
+
+        if isinstance(peripheral, simulation.VirtualAM43):
+            target = rng.randrange(101)
+            completed = asyncio.get_running_loop().create_future()
+            waiting[identifier] = (target, completed)
+            event, listener = 'command', lambda key, values: key == AM43.STATE_ID['move'] and values[0] == target and dispatch()
+            topic, data = f'{base_topic}/{identifier}/set/position', str(target)
+        else:
+            completed = dispatched
+            event, listener = 'press', dispatch
+            topic, data = f'{base_topic}/{identifier}/set/action', 'PRESS'
+        peripheral.on(event, listener)
+        start = time.monotonic()
+        try:
+            await driver.publish(topic, data.encode('utf8'), retain=False)
+            for stage, future in (('dispatch', dispatched), ('complete', completed)):
+                results[stage].append(await asyncio.wait_for(asyncio.shield(future), start + args.timeout - time.monotonic()) - start)
+        except asyncio.TimeoutError:
+            timeouts[stage] += 1
+        finally:
+            peripheral.remove_listener(event, listener)
+            waiting.pop(identifier, None)
+            async with released:
+                idle.add(identifier)
+                released.notify()
+
+    started = time.monotonic()
+    tasks = []
+    for index in range(args.commands):
+        await asyncio.sleep(max(0, started + index / args.rate - time.monotonic()))
+        async with released:
+            await released.wait_for(lambda: idle)
+            identifier = rng.choice(sorted(idle))
+            idle.remove(identifier)
+        tasks.append(asyncio.create_task(command(identifier)))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+    cpu = time.process_time() - cpu
+
+    report = {
+        'devices': len(devices),
+        'commands': args.commands,
+        'timeouts': dict(timeouts),
+        'startup': startup,
+        'elapsed': elapsed,
+        'throughput': args.commands / elapsed,
+        'dispatch_latency': percentiles(results['dispatch']),
+        'complete_latency': percentiles(results['complete']),
+        'cpu_per_command': cpu / args.commands,
+        'mqtt_received': dict(received),
+        'radio': {**sim.stats, 'connects_per_command': sim.stats['connects'] / args.commands},
+    }
+    bridge.cancel()
+    receiver.cancel()
+    await asyncio.gather(bridge, receiver, return_exceptions=True)
+    await driver.disconnect()
+    if broker:
+        await broker.shutdown()
+    return report
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Load benchmark of ble2mqtt against simulated devices')
+    parser.add_argument('--am43', type=int, default=10, help='number of simulated AM43 blinds')
+    parser.add_argument('--fingerbot', type=int, default=2, help='number of simulated Tuya fingerbots')
+    parser.add_argument('--commands', type=int, default=50, help='number of commands to send')
+    parser.add_argument('--rate', type=float, default=5, help='commands per second')
+    parser.add_argument('--capacity', type=int, default=6, help='controller capacity')
+    parser.add_argument('--connect-delay', type=float, default=1, help='seconds per simulated connect')
+    parser.add_argument('--disconnect-delay', type=float, default=1, help='seconds per simulated disconnect')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds before a simulated device replies')
+    parser.add_argument('--speed', type=float, default=50, help='AM43 motor speed in percent per second')
+    parser.add_argument('--idle-timeout', type=float, default=None, help='seconds before a fingerbot drops an idle connection')
+    parser.add_argument('--abort-rate', type=float, default=0, help='probability of le-connection-abort-by-local per connect')
+    parser.add_argument('--not-found-rate', type=float, default=0, help='probability of device not found per connect')
+    parser.add_argument('--write-error-rate', type=float, default=0, help='probability of a failed gatt write')
+    parser.add_argument('--mtu', type=int, default=23, help='ATT MTU of simulated connections')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds before a command counts as timed out')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--port', type=int, default=18830, help='port of the embedded MQTT broker')
+    parser.add_argument('--server', default=None, help='use this MQTT server instead of the embedded broker')
+    parser.add_argument('--trace', default=None, help='record the traffic of the bridge to this trace, see replay.py')
+    return parser
+
+
+if __name__ == '__main__':
+    print(json.dumps(asyncio.run(benchmark(get_parser().parse_args())), indent=2))
@@ -0,0 +1,153 @@
+'''
+Microbenchmark of the codecs in `crypto`, against the bit by bit implementations they replaced.
+
+    python3 benchmark_codec.py --save codec.json
+    python3 benchmark_codec.py --baseline codec.json --tolerance 0.2
+
+Every run first checks both implementations against fixed test vectors, then prints microseconds per call as JSON.
+With `--baseline`, exits with 1 if a codec got slower than the saved run or than its reference by more than `--tolerance`,
+timings only compare between runs on the same machine.
+'''
+import argparse
+import functools
+import json
+import sys
+import timeit
+
+import crypto
+
+
+def reference_xor_checksum(data):
+    checksum = 0
+    for byte in data:
+        checksum ^= byte
+    return checksum
+
+
+def reference_crc16_modbus(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte & 0xFF
+        for _ in range(8):
+            tmp = crc & 0x0001
+            crc >>= 1
+            if tmp:
+                crc ^= 0xA001
+    return crc
+
+
+def reference_pad_to_multiple(data, length):
+    data = bytearray(data)
+    while len(data) % length:
+        data += b'\x00'
+    return bytes(data)
+
+
+# the header and data of a Tuya command switching dp 1 on, see `device.tuya.util.create_message`
+TUYA_FRAME = bytes.fromhex('00000007000000000002000401010101')
+# an AM43 move to 50%, see `device.am43.AM43.create_command`
+AM43_COMMAND = (0x9a, 0x0d, 1, 50)
+PAIR_DATA = b'tuya0123456789ab' + b'012345' + b'0123456789abcdef'
+
+# (name, function, reference, arguments, expected)
+VECTORS = [
+    ('crc16_check', crypto.calc_crc16_modbus, reference_crc16_modbus, (b'123456789',), 0x4B37),
+    ('crc16_tuya_frame', crypto.calc_crc16_modbus, reference_crc16_modbus, (TUYA_FRAME,), 0xDBF7),
+    ('crc16_memoryview', crypto.calc_crc16_modbus, reference_crc16_modbus, (memoryview(TUYA_FRAME)[4:],), 0x6E26),
+    ('crc16_bytearray_1k', crypto.calc_crc16_modbus, reference_crc16_modbus, (bytearray(range(256)) * 4,), 0xECFE),
+    ('xor_am43_command', crypto.calc_xor_checksum, reference_xor_checksum, (AM43_COMMAND,), 0xA4),
+    ('xor_bytes', crypto.calc_xor_checksum, reference_xor_checksum, (bytes(range(256)),), 0x00),
+    ('xor_memoryview', crypto.calc_xor_checksum, reference_xor_checksum, (memoryview(TUYA_FRAME),), 0x01),
+    ('pad_tuya_frame', crypto.pad_to_multiple, reference_pad_to_multiple, (TUYA_FRAME[:14], 16), TUYA_FRAME[:14] + bytes(2)),
+    ('pad_aligned', crypto.pad_to_multiple, reference_pad_to_multiple, (TUYA_FRAME, 16), TUYA_FRAME),
+    ('pad_pair_request', crypto.pad_to_multiple, reference_pad_to_multiple, (PAIR_DATA, 44), PAIR_DATA + bytes(6)),
+]
+# only checked, not timed, none of them is a real workload, without a reference where it never handled them
+EDGE_CASES = [
+    ('crc16_empty', crypto.calc_crc16_modbus, reference_crc16_modbus, (b'',), 0xFFFF),
+    ('xor_wide_items', crypto.calc_xor_checksum, None, (memoryview(TUYA_FRAME).cast('H'),), 0x01),
+    ('pad_empty', crypto.pad_to_multiple, reference_pad_to_multiple, (b'', 16), b''),
+]
+
+
+def verify():
+    ''' returns the vectors either implementation gets wrong '''
+    failures = []
+    for name, function, reference, arguments, expected in VECTORS + EDGE_CASES:
+        for implementation in filter(None, (function, reference)):
+            result = implementation(*arguments)
+            if result != expected:
+                failures.append(f'{name}: {implementation.__name__} returned {result!r}, expected {expected!r}')
+    # continuing a CRC over parts is the same as over the whole
+    if crypto.calc_crc16_modbus(TUYA_FRAME[12:], crypto.calc_crc16_modbus(TUYA_FRAME[:12])) != crypto.calc_crc16_modbus(TUYA_FRAME):
+        failures.append('crc16_continuation: differs from a single pass')
+    return failures
+
+
+def measure(functions: list, arguments, number: int, repeat: int = 7):
+    ''' microseconds per call of each of `functions`, the best of `repeat`, taken in turns so that they see the same load '''
+    timers = [timeit.Timer(functools.partial(function, *arguments)) for function in functions]
+    timings = [[] for _ in timers]
+    for _ in range(repeat):
+        for timing, timer in zip(timings, timers):
+            timing.append(timer.timeit(number))
+    return [min(timing) / number * 1e6 for timing in timings]
+
+
+def benchmark(args):
+    results = {}
+    for name, function, reference, arguments, expected in VECTORS:
+        if args.skip_reference:
+            current, = measure([function], arguments, args.number)
+            results[name] = {'us': current}
+        else:
+            current, before = measure([function, reference], arguments, args.number)
+            results[name] = {'us': current, 'reference_us': before, 'speedup': before / current}
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    ''' returns the codecs slower than `baseline` or than their reference by more than `tolerance` '''
+    regressions = [
+        f'{name}: {result["us"]:.3f}us, baseline {baseline[name]["us"]:.3f}us'
+        for name, result in results.items()
+        if name in baseline and result['us'] > baseline[name]['us'] * (1 + tolerance)
+    ]
+    return regressions + [
+        f'{name}: {result["us"]:.3f}us, reference {result["reference_us"]:.3f}us'
+        for name, result in results.items()
+        if 'reference_us' in result and result['us'] > result['reference_us'] * (1 + tolerance)
+    ]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Microbenchmark of the codecs in crypto')
+    parser.add_argument('--number', type=int, default=2000, help='calls per timing')
+    parser.add_argument('--skip-reference', action='store_true', help='do not time the reference implementations')
+    parser.add_argument('--save', help='write the results to this file, as a baseline for later runs')
+    parser.add_argument('--baseline', help='results of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown against the baseline that fails, as a ratio')
+    return parser
+
+
+def main(args):
+    failures = verify()
+    if failures:
+        print('\n'.join(failures), file=sys.stderr)
+        return 1
+    results = benchmark(args)
+    print(json.dumps(results, indent=2))
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print('\n'.join(['regressions:', *regressions]), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_parser().parse_args()))
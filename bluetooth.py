@@ -3,6 +3,16 @@ from __future__ import annotations
 import asyncio
 import collections
 import collections.abc
+import contextlib
+import contextvars
+import enum
+import functools
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
 import uuid
 
 import bleak
@@ -12,27 +22,258 @@ import bleak.backends.device
 import bleak.backends.service
 import pyee
 
+import log
+import tracing
+
+logger = logging.getLogger(__name__)
+
 
 def expand_uuid(uuid: str | int):
     return f'{uuid:0>8}-0000-1000-8000-00805f9b34fb'
 
 
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    KEEPALIVE = 1
+    POLL = 2
+
+
+# priority of bluetooth operations issued from the current task
+current_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar('current_priority', default=Priority.INTERACTIVE)
+
+
+class Slot:
+    ''' the lock of a `Concurrency` as held by one `Concurrency.slot`, so that it is released exactly once '''
+
+    def __init__(self, concurrency: Concurrency, priority: Priority):
+        self.concurrency = concurrency
+        self.priority = priority
+        self.held = True
+
+    async def pause(self, delay: float):
+        ''' sleep without holding the lock, cancelled while waiting to get it back it is not held anymore '''
+        self.concurrency.release()
+        self.held = False
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            await self.concurrency.acquire(self.priority)
+            self.held = True
+
+
 class Concurrency:
     """
     BLE supports no more than 7 concurrent devices,
     and connect/disconnect incurs 1 second delay each.
-    This is an FIFO concurrency control
+    This is a priority scheduler:
+    1. waiters are served by priority, then FIFO
+    2. connected clients are evicted by priority, then least recently used
+    3. a client not used for `hold` seconds is demoted to the lowest priority
+    4. evicted clients disconnect in background, outside the lock
+    5. leased clients are never evicted, see `Client.lease`
     """
 
-    def __init__(self, capacity: int = 6):
+    def __init__(self, capacity: int = 6, hold: float = 30, adapter: str | None = None, failure_window: float = 60):
         self.capacity = capacity
-        self.queue: collections.OrderedDict[Client, None] = collections.OrderedDict()
-        self.lock = asyncio.Lock()
+        self.hold = hold
+        # hci adapter served by this pool, None for the system default
+        self.adapter = adapter
+        self.failure_window = failure_window
+        # address -> time of its last failed connect, cleared by any successful connect
+        self.failed: dict[str, float] = {}
+        self.scanner: Scanner | None = None
+        # connected clients, least recently used first, with the priority and time of their last use
+        self.queue: collections.OrderedDict[Client, tuple[Priority, float]] = collections.OrderedDict()
+        self.waiters: list[tuple[Priority, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+        self.locked = False
+        self.stats: collections.Counter[str] = collections.Counter()
+
+    async def acquire(self, priority: Priority):
+        start = time.monotonic()
+        if self.locked or self.waiters:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiters, (priority, next(self.counter), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # the lock may have been handed over right before cancellation
+                if future.done() and not future.cancelled():
+                    self.release()
+                raise
+        else:
+            self.locked = True
+        wait = time.monotonic() - start
+        self.stats['waits'] += 1
+        self.stats['wait_time'] += wait
+        self.stats['wait_time_max'] = max(self.stats['wait_time_max'], wait)
+
+    def release(self):
+        while self.waiters:
+            *_, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.locked = False
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: Priority):
+        ''' holds the lock, the `Slot` yielded can let go of it for a while '''
+        await self.acquire(priority)
+        slot = Slot(self, priority)
+        try:
+            yield slot
+        finally:
+            if slot.held:
+                self.release()
+
+    def fail(self, address: str):
+        self.failed[address] = time.monotonic()
+
+    def succeed(self):
+        self.failed.clear()
+
+    @property
+    def failures(self):
+        ''' distinct devices that failed to connect within `failure_window` seconds, so that one missing device cannot condemn the adapter '''
+        now = time.monotonic()
+        return sum(now - failed_at < self.failure_window for failed_at in self.failed.values())
+
+    @property
+    def waiting(self):
+        ''' connects waiting for the lock, not those cancelled meanwhile '''
+        return sum(not future.done() for *_, future in self.waiters)
+
+    @property
+    def saturated(self):
+        ''' connects queue up behind the lock or none of the connected clients can be evicted, a full queue alone is the steady state '''
+        return self.waiting > 0 or (len(self.queue) >= self.capacity and all(client.leased for client in self.queue))
+
+    @property
+    def busy(self):
+        ''' a connect is in progress or waiting, speculative work should not add to it '''
+        return self.locked
+
+    def touch(self, client: Client, priority: Priority):
+        now = time.monotonic()
+        last_priority, last_used = self.queue.pop(client, (priority, now))
+        if now - last_used < self.hold:
+            priority = min(priority, last_priority)
+        self.queue[client] = (Priority(priority), now)
+
+    def demote(self, client: Client):
+        ''' make a connected client the first to be evicted '''
+        if client in self.queue:
+            self.queue[client] = (Priority.POLL, -math.inf)
+            self.queue.move_to_end(client, last=False)
+
+    def evict(self):
+        now = time.monotonic()
+
+        def rank(client: Client):
+            priority, last_used = self.queue[client]
+            return (priority if now - last_used < self.hold else Priority.POLL, -last_used)
+
+        while len(self.queue) > self.capacity:
+            candidates = [client for client in itertools.islice(self.queue, len(self.queue) - 1) if not client.leased]
+            if not candidates:
+                self.stats['evictions_blocked'] += 1
+                break
+            victim = max(candidates, key=rank)
+            priority, _ = self.queue.pop(victim)
+            self.stats['evictions'] += 1
+            self.stats[f'evictions_{priority.name.lower()}'] += 1
+            victim.disconnection = asyncio.create_task(victim.disconnect())
+
+    def report(self):
+        return {
+            'adapter': self.adapter,
+            'capacity': self.capacity,
+            'connected': len(self.queue),
+            'waiting': self.waiting,
+            **self.stats,
+            'wait_time_avg': self.stats['wait_time'] / self.stats['waits'] if self.stats['waits'] else 0,
+        }
 
 
 concurrency = Concurrency()
 
 
+class AdapterPool:
+    """
+    Shards devices across several bluetooth adapters, each with its own `Concurrency`.
+    Devices are placed statically or by best RSSI,
+    and move to another adapter that has seen them when theirs is saturated or unhealthy.
+    An adapter is unhealthy while `unhealthy` distinct devices failed to connect through it, see `Concurrency.failures`,
+    it is tried again once their failures are older than its `failure_window`.
+    Devices pinned to an adapter never move, see `registry.create_device`.
+    """
+
+    def __init__(self, concurrencies: list[Concurrency], unhealthy: int = 3):
+        self.concurrencies = concurrencies
+        self.unhealthy = unhealthy
+        # address -> adapter -> rssi
+        self.rssi: dict[str, dict[str | None, int]] = collections.defaultdict(dict)
+        self.assigned: collections.Counter[Concurrency] = collections.Counter()
+
+    def __getitem__(self, adapter: str | None):
+        return next(concurrency for concurrency in self.concurrencies if concurrency.adapter == adapter)
+
+    async def start_scanners(self, absent_after: float = 120):
+        for concurrency in self.concurrencies:
+            concurrency.scanner = Scanner(concurrency.adapter, absent_after)
+            concurrency.scanner.on('detection', functools.partial(self.observe, concurrency))
+            await concurrency.scanner.start()
+
+    async def stop_scanners(self):
+        for concurrency in self.concurrencies:
+            if concurrency.scanner:
+                await concurrency.scanner.stop()
+
+    def observe(self, concurrency: Concurrency, address: str, rssi: int):
+        self.rssi[address][concurrency.adapter] = rssi
+
+    async def scan(self, timeout: float = 5):
+        ''' fill `rssi`, just wait for the scanners if every adapter runs one '''
+        if all(concurrency.scanner for concurrency in self.concurrencies):
+            return await asyncio.sleep(timeout)
+
+        async def scan_adapter(concurrency: Concurrency):
+            discovered = await bleak.BleakScanner.discover(timeout, return_adv=True, adapter=concurrency.adapter)
+            for device, advertisement in discovered.values():
+                self.rssi[device.address.upper()][concurrency.adapter] = advertisement.rssi
+
+        await asyncio.gather(*(scan_adapter(concurrency) for concurrency in self.concurrencies))
+
+    def place(self, address: str, adapter: str | None = None) -> Concurrency:
+        rssi = self.rssi[address.upper()]
+        if adapter is not None:
+            concurrency = self[adapter]
+        elif rssi:
+            concurrency = max((concurrency for concurrency in self.concurrencies if concurrency.adapter in rssi),
+                              key=lambda concurrency: rssi[concurrency.adapter])
+        else:
+            concurrency = min(self.concurrencies, key=lambda concurrency: self.assigned[concurrency] / concurrency.capacity)
+        self.assigned[concurrency] += 1
+        return concurrency
+
+    def is_available(self, concurrency: Concurrency):
+        return concurrency.failures < self.unhealthy and not concurrency.saturated
+
+    def select(self, client: Client) -> Concurrency:
+        ''' the adapter `client` should connect through, preferably its current one '''
+        if self.is_available(client.concurrency):
+            return client.concurrency
+        rssi = self.rssi[client.address.upper()]
+        candidates = [
+            concurrency for concurrency in self.concurrencies
+            if self.is_available(concurrency) and concurrency.adapter in rssi
+        ]
+        if not candidates:
+            return client.concurrency
+        return max(candidates, key=lambda concurrency: (rssi.get(concurrency.adapter, 0), -len(concurrency.queue)))
+
+
 class EventEmitter(pyee.EventEmitter):
 
     def once_async(self, event):
@@ -52,6 +293,184 @@ class EventEmitter(pyee.EventEmitter):
             self.remove_listener(event, listener)
 
 
+class DeviceAbsentError(bleak.exc.BleakDeviceNotFoundError):
+    pass
+
+
+class CircuitOpenError(DeviceAbsentError):
+    ''' the device failed too often, operations fail right away until a probe reaches it, see `CircuitBreaker` '''
+    pass
+
+
+class Scanner(EventEmitter):
+    """
+    One continuous scan per adapter, shared by all clients on it.
+    It keeps the last `BLEDevice`, last seen time and RSSI of every advertising device,
+    so that clients connect without a discovery of their own.
+    A device not seen for `absent_after` seconds is absent and connecting to it fails fast.
+    """
+
+    def __init__(self, adapter: str | None = None, absent_after: float = 120):
+        super().__init__()
+        self.adapter = adapter
+        self.absent_after = absent_after
+        self.devices: dict[str, tuple[bleak.backends.device.BLEDevice, float, int]] = {}
+        self.started: float | None = None
+        self.scanner: bleak.BleakScanner | None = None
+
+    def on_detection(self, device: bleak.backends.device.BLEDevice, advertisement):
+        address = device.address.upper()
+        self.devices[address] = (device, time.monotonic(), advertisement.rssi)
+        self.emit('detection', address, advertisement.rssi)
+
+    async def start(self):
+        self.scanner = bleak.BleakScanner(self.on_detection, adapter=self.adapter)
+        await self.scanner.start()
+        self.started = time.monotonic()
+
+    async def stop(self):
+        if self.scanner:
+            await self.scanner.stop()
+            self.scanner = None
+            self.started = None
+
+    def touch(self, address: str):
+        ''' connected devices stop advertising, so a disconnect counts as seen '''
+        address = address.upper()
+        if address in self.devices:
+            device, _, rssi = self.devices[address]
+            self.devices[address] = (device, time.monotonic(), rssi)
+
+    def get(self, address: str) -> bleak.backends.device.BLEDevice | None:
+        device, *_ = self.devices.get(address.upper(), (None, ))
+        return device
+
+    def is_absent(self, address: str):
+        now = time.monotonic()
+        if not self.started or now - self.started < self.absent_after:
+            return False
+        _, last_seen, _ = self.devices.get(address.upper(), (None, self.started, None))
+        return now - last_seen > self.absent_after
+
+
+class Correlator:
+    """
+    Matches responses to the requests they answer, so that several requests can be in flight at once.
+    1. `match` maps a response to the key of the request it answers, None for an unsolicited one
+    2. no more than `window` requests are in flight, further ones wait for an answer or a timeout
+    3. a request unanswered within `timeout` seconds raises asyncio.TimeoutError
+    Requests with the same key are answered in order.
+    """
+
+    def __init__(self, match: collections.abc.Callable[[object], collections.abc.Hashable | None], window: int = 4, timeout: float = 5):
+        self.match = match
+        self.window = asyncio.Semaphore(window)
+        self.timeout = timeout
+        self.pending: collections.defaultdict[collections.abc.Hashable, collections.deque[asyncio.Future]] = collections.defaultdict(
+            collections.deque)
+
+    def feed(self, response) -> bool:
+        ''' whether `response` answered a request '''
+        futures = self.pending.get(self.match(response))
+        while futures:
+            future = futures.popleft()
+            if not future.done():
+                future.set_result(response)
+                return True
+        return False
+
+    async def request(self, key: collections.abc.Hashable, send: collections.abc.Callable[[], collections.abc.Awaitable], timeout: float | None = None):
+        async with self.window:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key].append(future)
+            try:
+                await send()
+                return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+            finally:
+                with contextlib.suppress(ValueError):
+                    self.pending[key].remove(future)
+                if not self.pending[key]:
+                    del self.pending[key]
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter.
+    Attempt `n` (from 0) waits `base * factor ** n` seconds, at most `cap`,
+    less a random share of up to `jitter` of it, so that clients failing together do not retry together.
+    """
+
+    def __init__(self, attempts: int = 10, base: float = 1, factor: float = 2, cap: float = 30, jitter: float = 0.5):
+        self.attempts = attempts
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+
+    def delay(self, attempt: int) -> float:
+        return min(self.cap, self.base * self.factor ** attempt) * (1 - self.jitter * random.random())
+
+
+class CircuitBreaker:
+    """
+    Keeps a missing device from holding up the others.
+    1. `threshold` failed connects in a row open the circuit, connects then fail right away with `CircuitOpenError`
+    2. `reset_timeout` seconds later a single probe may go through, the timeout doubles up to `max_reset_timeout` while probes fail
+    3. a successful connect closes the circuit
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30, max_reset_timeout: float = 600):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.timeout = reset_timeout
+        self.probing = False
+
+    @property
+    def closed(self):
+        return self.opened_at is None
+
+    def remaining(self) -> float:
+        ''' seconds until a probe may go through '''
+        return 0 if self.closed else max(0, self.opened_at + self.timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        ''' whether a connect may go through, the first one after `remaining` is the probe '''
+        if self.closed:
+            return True
+        if self.probing or self.remaining() > 0:
+            return False
+        self.probing = True
+        return True
+
+    def success(self) -> bool:
+        ''' whether the circuit closed '''
+        opened = not self.closed
+        self.failures = 0
+        self.opened_at = None
+        self.timeout = self.reset_timeout
+        self.probing = False
+        return opened
+
+    def abandon(self):
+        ''' a probe ended without an outcome, e.g. it was cancelled while waiting for a slot, the next connect may probe '''
+        self.probing = False
+
+    def failure(self) -> bool:
+        ''' whether the circuit opened '''
+        self.failures += 1
+        if self.probing:
+            self.probing = False
+            self.opened_at = time.monotonic()
+            self.timeout = min(self.timeout * 2, self.max_reset_timeout)
+        elif self.closed and self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+
 class Client(bleak.BleakClient):
     '''
     A wrapper of bleak.BleakClient
@@ -60,18 +479,83 @@ class Client(bleak.BleakClient):
     1. hide connect-disconnect from consumer
     2. work across connect-disconnect-reconnect
     3. observe concurrency limit
-    4. retry automatically if needed
+    4. retry automatically if needed, backing off by `retry`
+    5. stop trying a device that keeps failing, see `CircuitBreaker`
+
+    Emits `unavailable` when the circuit opens and `available` when a probe closes it.
     '''
 
-    def __init__(self, address: bleak.backends.device.BLEDevice | str, concurrency: Concurrency = concurrency):
+    def __init__(self,
+                 address: bleak.backends.device.BLEDevice | str,
+                 concurrency: Concurrency = concurrency,
+                 pool: AdapterPool | None = None,
+                 retry: RetryPolicy | None = None,
+                 breaker: CircuitBreaker | None = None,
+                 **kwargs):
         event = EventEmitter()
-        super().__init__(address, disconnected_callback=lambda _: self.event.emit('disconnect'))
-        self.event = event
+        self.device = address
+        self.kwargs = kwargs
         self.concurrency = concurrency
+        self.pool = pool
+        self.rebuild()
+        self.event = event
         self.connect_finalizer = None
+        self.disconnection: asyncio.Task | None = None
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.prober: asyncio.Task | None = None
+        # whether a disconnect was asked for, rather than the device going away
+        self.disconnecting = False
+        # monotonic time until which the connection is pinned, the latest expiry of the leases held, see `lease`
+        self.lease_expiry = 0.0
+        self.lease_expiries: list[float] = []
+        # ATT MTU negotiated with the device, the minimum until it is known
+        self.mtu = 23
+        # notification characteristic -> Correlator, see `request`
+        self.correlators: dict[str, Correlator] = {}
+        # characteristic -> ({handler: None}, start_notify kwargs), see `subscribe`
+        self.subscriptions: dict[str, tuple[dict[collections.abc.Callable, None], dict]] = {}
+        # characteristics notifying on the current connection
+        self.notifying: set[str] = set()
         self.event.on('disconnect', lambda: self.concurrency.queue.pop(self, None))
-        self.event.on('disconnect', lambda: print(f'<5>bluetooth.Client.event.disconnect {self.address}'))
-        self.event.on('connect', lambda: print(f'<6>bluetooth.Client.event.connect {self.address}'))
+        self.event.on('disconnect', self.notifying.clear)
+        self.event.on('disconnect', lambda: self.concurrency.scanner and self.concurrency.scanner.touch(self.address))
+        self.event.on('disconnect', lambda: logger.log(log.NOTICE, 'bluetooth.Client.event.disconnect %s', self.address))
+        self.event.on('connect', lambda: logger.info('bluetooth.Client.event.connect %s', self.address))
+        self.event.on('connect', lambda: tracing.recorder.record('connect', self.address))
+        self.event.on('disconnect', lambda: tracing.recorder.record('disconnect', self.address, self.disconnecting))
+
+    def rebuild(self):
+        ''' (re)create the bleak backend, e.g. after moving to another adapter '''
+        kwargs = dict(self.kwargs)
+        if self.concurrency.adapter is not None:
+            kwargs['adapter'] = self.concurrency.adapter
+        super().__init__(self.device, disconnected_callback=lambda _: self.event.emit('disconnect'), **kwargs)
+
+    def migrate(self, concurrency: Concurrency):
+        ''' move a disconnected client to another adapter '''
+        logger.log(log.NOTICE, 'bluetooth.Client.migrate %s from %s to %s', self.address, self.concurrency.adapter, concurrency.adapter)
+        self.concurrency.queue.pop(self, None)
+        self.concurrency = concurrency
+        self.device = self.address
+        self.mtu = 23
+        self.rebuild()
+
+    def resolve(self):
+        ''' use the `BLEDevice` cached by the adapter scanner, if any, so that connecting needs no discovery '''
+        scanner = self.concurrency.scanner
+        if not scanner:
+            return
+        if scanner.is_absent(self.address):
+            raise DeviceAbsentError(self.address, f'Device with address {self.address} was not seen for {scanner.absent_after} seconds')
+        device = scanner.get(self.address)
+        if device and device is not self.device:
+            self.device = device
+            self.rebuild()
+
+    def release(self):
+        ''' done with the connection for now, let others evict it first '''
+        self.concurrency.demote(self)
 
     async def connect_finalizer_body(self):
         """
@@ -88,83 +572,309 @@ class Client(bleak.BleakClient):
         finally:
             await self.disconnect()
 
+    @property
+    def leased(self):
+        return self.lease_expiry > time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def lease(self, max_hold: float = 10, priority: Priority | None = None):
+        '''
+        Pins the connection for a burst of operations, e.g. the packets of one message.
+        1. the connection is not evicted for others during the lease
+        2. operations within the lease skip the scheduler and go straight to the connection
+        3. the lease expires after `max_hold` seconds, even if still held, so that others are not starved
+        '''
+        await self.connect(priority)
+        # leases of concurrent tasks may end in any order
+        expiry = time.monotonic() + max_hold
+        self.lease_expiries.append(expiry)
+        self.lease_expiry = max(self.lease_expiries)
+        try:
+            yield self
+        finally:
+            if time.monotonic() > expiry:
+                logger.warning('bluetooth.Client.lease %s held beyond %s seconds', self.address, max_hold)
+            self.lease_expiries.remove(expiry)
+            self.lease_expiry = max(self.lease_expiries, default=0.0)
+            if self in self.concurrency.queue:
+                self.concurrency.touch(self, current_priority.get() if priority is None else priority)
+
     # first queue, then backend
-    async def connect(self):
-        async with self.concurrency.lock:
+    async def connect(self, priority: Priority | None = None):
+        # an evicted client stays connected until its disconnection completes
+        if self.leased and self.is_connected and not self.disconnection:
+            return True
+        priority = current_priority.get() if priority is None else priority
+        probe = False
+        if not self.is_connected:
+            if not self.breaker.allow():
+                raise CircuitOpenError(self.address, f'Device with address {self.address} is unavailable, next probe in {self.breaker.remaining():.0f} seconds')
+            # the breaker let this connect through as its probe
+            probe = not self.breaker.closed
+        if self.pool and not self.is_connected:
+            concurrency = self.pool.select(self)
+            if concurrency is not self.concurrency:
+                self.migrate(concurrency)
+        try:
+            return await self.establish(priority)
+        finally:
+            if probe:
+                self.breaker.abandon()
+
+    async def establish(self, priority: Priority):
+        ''' the part of `connect` within a slot of the adapter '''
+        async with self.concurrency.slot(priority) as slot:
+            if self.disconnection:
+                with contextlib.suppress(Exception):
+                    await self.disconnection
+                self.disconnection = None
             if not self.connect_finalizer:
                 self.connect_finalizer = self.connect_finalizer_body()
                 await self.connect_finalizer.__anext__()
-            self.concurrency.queue[self] = None
-            self.concurrency.queue.move_to_end(self, last=True)
-            while len(self.concurrency.queue) > self.concurrency.capacity:
-                await self.concurrency.queue.popitem(last=False)[0].disconnect()
+            self.concurrency.touch(self, priority)
+            self.concurrency.evict()
             if not self.is_connected:
-                for _ in range(10):
+                # a probe is a single attempt
+                attempts = 1 if self.breaker.probing else self.retry.attempts
+                for attempt in range(attempts):
                     try:
+                        self.resolve()
                         data = await super().connect()
+                        await self.acquire_mtu()
+                        await self.resubscribe()
+                        self.concurrency.succeed()
+                        if self.breaker.success():
+                            logger.log(log.NOTICE, 'bluetooth.Client.connect %s available again', self.address)
+                            self.event.emit('available')
                         self.event.emit('connect')
                         return data
                     except bleak.exc.BleakDBusError as error:
+                        self.concurrency.fail(self.address)
+                        self.fail(error)
                         if error.dbus_error == 'org.bluez.Error.Failed' and error.dbus_error_details == 'le-connection-abort-by-local':
-                            print(f'<4>bluetooth.Client.connect {self.address} retry because dbus: {error.dbus_error_details}')
-                            self.concurrency.lock.release()
-                            await asyncio.sleep(3)
-                            await self.concurrency.lock.acquire()
+                            logger.warning('bluetooth.Client.connect %s retry because dbus: %s', self.address, error.dbus_error_details)
+                            await slot.pause(self.retry.delay(attempt))
                         else:
                             raise
+                    except DeviceAbsentError as error:
+                        self.fail(error)
+                        raise
                     except bleak.exc.BleakDeviceNotFoundError as error:
-                        await bleak.BleakScanner.find_device_by_address(error.identifier)
-                        self.concurrency.lock.release()
-                        await asyncio.sleep(3)
-                        await self.concurrency.lock.acquire()
+                        self.fail(error)
+                        if self.concurrency.scanner:
+                            # the cached BLEDevice may be stale, wait for the scanner to see the device again
+                            self.device = self.address
+                            self.rebuild()
+                        else:
+                            await bleak.BleakScanner.find_device_by_address(error.identifier)
+                        await slot.pause(self.retry.delay(attempt))
+                    except Exception as error:
+                        self.fail(error)
+                        raise
+                raise bleak.exc.BleakError(f'Device with address {self.address} did not connect in {attempts} attempts')
+
+    def fail(self, error: Exception):
+        ''' count a failed connect, raises `CircuitOpenError` once the circuit is open '''
+        if isinstance(error, CircuitOpenError):
+            return
+        tracing.recorder.record('error', self.address, repr(error))
+        if self.breaker.failure():
+            logger.warning('bluetooth.Client.connect %s unavailable after %d failures, last: %r', self.address, self.breaker.failures, error)
+            self.event.emit('unavailable')
+            self.start_probing()
+        if not self.breaker.closed:
+            raise CircuitOpenError(self.address, f'Device with address {self.address} is unavailable') from error
+
+    def start_probing(self):
+        ''' probe in background while the circuit is open, unless already probing '''
+        if not self.breaker.closed and (not self.prober or self.prober.done()):
+            self.prober = asyncio.create_task(self.probe())
+
+    def stop_probing(self):
+        if self.prober:
+            self.prober.cancel()
+            self.prober = None
+
+    async def probe(self):
+        ''' while the circuit is open, let a connect at the lowest priority through whenever the breaker allows one '''
+        while not self.breaker.closed:
+            # at least a second, another connect may hold the probe
+            await asyncio.sleep(max(self.breaker.remaining(), 1))
+            scanner = self.concurrency.scanner
+            if scanner and scanner.is_absent(self.address):
+                # no need for the radio to know it is still missing
+                if self.breaker.allow():
+                    self.breaker.failure()
+                continue
+            with contextlib.suppress(Exception):
+                await self.connect(Priority.POLL)
+                # do not keep a connection nobody asked for from others
+                self.release()
+
+    async def disconnect(self):
+        self.disconnecting = True
+        try:
+            return await super().disconnect()
+        finally:
+            self.disconnecting = False
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.stop_probing()
+        await super().__aexit__(exc_type, exc_value, traceback)
+
+    async def acquire_mtu(self):
+        ''' BlueZ reports the minimum MTU unless asked for the negotiated one, other backends know it already '''
+        try:
+            if hasattr(self._backend, '_acquire_mtu'):
+                await self._backend._acquire_mtu()
+            self.mtu = self.mtu_size
+        except Exception as error:
+            logger.debug('bluetooth.Client.acquire_mtu %s keeps %d because: %r', self.address, self.mtu, error)
+
+    @property
+    def write_size(self) -> int:
+        ''' the largest write without response, an ATT MTU less the 3 bytes of the ATT header '''
+        return self.mtu - 3
 
     async def send(self,
                    char_specifier: bleak.backends.characteristic.BleakGATTCharacteristic | int | str | uuid.UUID,
                    data: collections.abc.Iterable[int],
                    response: bool = False,
-                   retry: int = 10):
-        for _ in range(retry):
+                   priority: Priority | None = None):
+        for attempt in range(self.retry.attempts):
             try:
-                await self.connect()
-                return await self.write_gatt_char(char_specifier=char_specifier, data=data, response=response)
+                await self.connect(priority)
+                result = await self.write_gatt_char(char_specifier=char_specifier, data=data, response=response)
+                tracing.recorder.record('write', self.address, str(char_specifier), data)
+                return result
+            except DeviceAbsentError:
+                raise
             except bleak.BleakError as error:
-                print(f'<4>bluetooth.Client.send {self.address} retry because: {error}')
+                tracing.recorder.record('error', self.address, repr(error))
+                logger.warning('bluetooth.Client.send %s retry because: %s', self.address, error)
                 await self.disconnect()
-                await asyncio.sleep(3)
+                await asyncio.sleep(self.retry.delay(attempt))
+        raise bleak.exc.BleakError(f'Device with address {self.address} failed {self.retry.attempts} writes')
+
+    def correlate(self,
+                  char_specifier: bleak.backends.characteristic.BleakGATTCharacteristic | int | str | uuid.UUID,
+                  match: collections.abc.Callable[[bytearray], collections.abc.Hashable | None],
+                  **kwargs):
+        ''' declare how notifications of `char_specifier` answer a `request`, `kwargs` are passed to `Correlator` '''
+        self.correlators[str(char_specifier)] = Correlator(match, **kwargs)
+
+    async def subscribe(self,
+                        char_specifier: bleak.backends.characteristic.BleakGATTCharacteristic | int | str | uuid.UUID,
+                        handler: collections.abc.Callable[[int, bytearray], None],
+                        **kwargs):
+        '''
+        Call `handler` on every notification of `char_specifier`, across reconnects.
+        It does not call `connect` implicitly, subscriptions are restored on every connect.
+        A handler is only registered once, `kwargs` of the first subscription are passed to `start_notify`.
+        '''
+        key = str(char_specifier)
+        handlers, _ = self.subscriptions.setdefault(key, ({}, kwargs))
+        handlers[handler] = None
+        if self.is_connected and key not in self.notifying:
+            await self.start_notifying(key)
+
+    async def unsubscribe(self,
+                          char_specifier: bleak.backends.characteristic.BleakGATTCharacteristic | int | str | uuid.UUID,
+                          handler: collections.abc.Callable[[int, bytearray], None]):
+        ''' notifications stop with the last handler of a characteristic '''
+        key = str(char_specifier)
+        if key not in self.subscriptions:
+            return
+        handlers, _ = self.subscriptions[key]
+        handlers.pop(handler, None)
+        if handlers:
+            return
+        del self.subscriptions[key]
+        if self.is_connected and key in self.notifying:
+            self.notifying.discard(key)
+            with contextlib.suppress(bleak.BleakError):
+                await self.stop_notify(key)
+
+    async def start_notifying(self, key: str):
+        self.notifying.add(key)
+        try:
+            await self.start_notify(key, functools.partial(self.notify, key), **self.subscriptions[key][1])
+        except Exception:
+            self.notifying.discard(key)
+            raise
+
+    async def resubscribe(self):
+        ''' restore all subscriptions on a new connection at once '''
+        await asyncio.gather(*(self.start_notifying(key) for key in list(self.subscriptions) if key not in self.notifying))
+
+    def notify(self, key: str, sender: int, data: bytearray):
+        ''' notifications answering a `request` are matched before they reach the handlers '''
+        tracing.recorder.record('notify', self.address, key, data)
+        if key in self.correlators:
+            self.correlators[key].feed(data)
+        handlers, _ = self.subscriptions.get(key, ({}, {}))
+        for handler in list(handlers):
+            handler(sender, data)
+
+    async def request(self,
+                      char_specifier: bleak.backends.characteristic.BleakGATTCharacteristic | int | str | uuid.UUID,
+                      data: collections.abc.Iterable[int],
+                      key: collections.abc.Hashable,
+                      notify_specifier: bleak.backends.characteristic.BleakGATTCharacteristic | int | str | uuid.UUID | None = None,
+                      timeout: float | None = None,
+                      priority: Priority | None = None) -> bytearray:
+        '''
+        `send` and return the notification matched to `key`, see `correlate`.
+        Notifications come from `notify_specifier`, by default the same characteristic.
+        '''
+        correlator = self.correlators[str(notify_specifier or char_specifier)]
+        return await correlator.request(key, lambda: self.send(char_specifier, data, priority=priority), timeout)
 
     async def recv(self, char_specifier: bleak.backends.characteristic.BleakGATTCharacteristic | int | str | uuid.UUID):
-        future: asyncio.Future[tuple[int, bytearray]] = asyncio.Future()
+        future: asyncio.Future[tuple[int, bytearray]] = asyncio.get_running_loop().create_future()
+
+        def handler(sender: int, data: bytearray):
+            if not future.done():
+                future.set_result((sender, data))
+
         await self.connect()
-        await self.start_notify(char_specifier, lambda sender, data: future.set_result((sender, data)))
+        await self.subscribe(char_specifier, handler)
         try:
             return await future
         finally:
-            await self.stop_notify(char_specifier)
+            await self.unsubscribe(char_specifier, handler)
 
     async def recv_stream(self, char_specifier: bleak.backends.characteristic.BleakGATTCharacteristic | int | str | uuid.UUID, **kwargs):
+        ''' notifications until the next disconnect '''
         loop = asyncio.get_running_loop()
-        future = asyncio.Future()
+        disconnected = loop.create_future()
         queue = asyncio.Queue()
+        handler = lambda sender, data: loop.call_soon_threadsafe(queue.put_nowait, (sender, data))
+        on_disconnect = lambda: disconnected.done() or disconnected.set_result(None)
         await self.connect()
-        await self.start_notify(char_specifier, lambda sender, data: loop.call_soon_threadsafe(queue.put_nowait, (sender, data)), **kwargs)
-        self.event.on('disconnect', lambda: future.set_exception(StopAsyncIteration()))
+        await self.subscribe(char_specifier, handler, **kwargs)
+        self.event.on('disconnect', on_disconnect)
         try:
             while True:
-                yield await asyncio.wait((queue.get(), future), asyncio.FIRST_EXCEPTION)
+                get = asyncio.ensure_future(queue.get())
+                await asyncio.wait((get, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    return
+                yield get.result()
         finally:
-            await self.stop_notify(char_specifier)
+            self.event.remove_listener('disconnect', on_disconnect)
+            await self.unsubscribe(char_specifier, handler)
 
     async def recv_stream_opportunistic(self, char_specifier: bleak.backends.characteristic.BleakGATTCharacteristic | int | str | uuid.UUID,
                                         **kwargs):
         ''' This method passively listen for messages as they come by. It does not call `connect` implicitly. '''
         loop = asyncio.get_running_loop()
         queue = asyncio.Queue()
-        listener = lambda sender, data: loop.call_soon_threadsafe(queue.put_nowait, (sender, data))
-        if self.is_connected:
-            await self.start_notify(char_specifier, listener, **kwargs)
-        self.event.on('connect', lambda: asyncio.create_task(self.start_notify(char_specifier, listener, **kwargs)))
+        handler = lambda sender, data: loop.call_soon_threadsafe(queue.put_nowait, (sender, data))
+        await self.subscribe(char_specifier, handler, **kwargs)
         try:
             while True:
                 yield await queue.get()
         finally:
-            await self.stop_notify(char_specifier)
+            await self.unsubscribe(char_specifier, handler)
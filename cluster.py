@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import math
+import time
+
+import bluetooth
+import log
+import publish
+import registry
+from device.interface import BaseDevice
+
+logger = logging.getLogger(__name__)
+
+
+class Cluster(bluetooth.EventEmitter):
+    '''
+    Several bridges sharing one broker, each owning the devices it hears best.
+
+    1. every node announces on `{topic}/{node}` the devices it can reach, with the RSSI its scanners saw, and the ones it owns
+    2. an announcement is a lease of `lease` seconds, the devices of a node that stops announcing fail over to the others
+    3. every node elects the same owner from the same announcements:
+       the owner keeps a device unless another node hears it `margin` dB better, ties go to the greater node name
+    4. only the owner handles commands and polls a device, the others leave it disconnected
+
+    Emits `acquire` and `release` with the device when its ownership changes.
+    '''
+
+    def __init__(self,
+                 mqtt: publish.Outbox,
+                 topic: str,
+                 devices_reg: registry.Registry,
+                 node: str,
+                 interval: float = 10,
+                 lease: float = 30,
+                 margin: float = 10):
+        super().__init__()
+        self.mqtt = mqtt
+        self.topic = topic
+        self.devices_reg = devices_reg
+        self.node = node
+        self.interval = interval
+        self.lease = lease
+        self.margin = margin
+        # node -> (received at, announcement)
+        self.nodes: dict[str, tuple[float, dict]] = {}
+        # upper case addresses owned by this node
+        self.owned: set[str] = set()
+
+    def owns(self, device: BaseDevice) -> bool:
+        return device.client.address.upper() in self.owned
+
+    def get_announcement(self):
+        pool = self.devices_reg.pool
+        devices = {}
+        for address in self.devices_reg.devices:
+            rssi = pool.rssi.get(address.upper())
+            devices[address.upper()] = max(rssi.values()) if rssi else None
+        return {'devices': devices, 'owned': sorted(self.owned)}
+
+    async def announce(self):
+        announcement = self.get_announcement()
+        self.nodes[self.node] = (time.monotonic(), announcement)
+        await self.mqtt.publish(f'{self.topic}/{self.node}', json.dumps(announcement).encode('utf8'), retain=False)
+
+    def observe(self, node: str, data: str):
+        if node == self.node:
+            return
+        try:
+            announcement = json.loads(data)
+            self.nodes[node] = (time.monotonic(), {'devices': dict(announcement['devices']), 'owned': list(announcement['owned'])})
+        except (ValueError, KeyError, TypeError) as error:
+            logger.warning('cluster.Cluster.observe %s ignored because: %r', node, error)
+
+    def elect(self, address: str) -> str | None:
+        now = time.monotonic()
+        alive = {
+            node: announcement for node, (received_at, announcement) in self.nodes.items()
+            if now - received_at < self.lease and address in announcement['devices']
+        }
+        if not alive:
+            return None
+
+        def strength(node: str):
+            rssi = alive[node]['devices'][address]
+            return -math.inf if rssi is None else rssi
+
+        best = max(alive, key=lambda node: (strength(node), node))
+        owners = [node for node in alive if address in alive[node]['owned']]
+        if owners:
+            owner = max(owners, key=lambda node: (strength(node), node))
+            if strength(owner) + self.margin >= strength(best):
+                return owner
+        return best
+
+    def update(self):
+        devices = {address.upper(): device for address, device in self.devices_reg.devices.items()}
+        owned = {address for address in devices if self.elect(address) == self.node}
+        released, acquired = self.owned - owned, owned - self.owned
+        self.owned = owned
+        for address in sorted(released & set(devices)):
+            logger.log(log.NOTICE, 'cluster.Cluster.update %s released %s', self.node, address)
+            self.emit('release', devices[address])
+        for address in sorted(acquired):
+            logger.log(log.NOTICE, 'cluster.Cluster.update %s acquired %s', self.node, address)
+            self.emit('acquire', devices[address])
+
+    async def run(self):
+        ''' the first election waits one `interval` for the announcements of the other nodes '''
+        await self.announce()
+        while True:
+            await asyncio.sleep(self.interval)
+            self.update()
+            await self.announce()
+
+    async def leave(self):
+        ''' let the other nodes take over right away '''
+        self.owned = set()
+        await self.mqtt.publish(f'{self.topic}/{self.node}', json.dumps({'devices': {}, 'owned': []}).encode('utf8'), retain=False)
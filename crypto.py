@@ -2,22 +2,53 @@ import collections.abc
 import secrets
 
 
+# iterated as they are, checked inline as a call costs as much as a short frame
+BYTE_SEQUENCES = (bytes, bytearray, tuple, list)
+
+
+def as_buffer(data: collections.abc.Iterable[int]):
+    ''' buffers as a view of their bytes whatever their item size, other iterables as they are, nothing is copied '''
+    try:
+        return memoryview(data).cast('B')
+    except TypeError:
+        return data
+
+
 def calc_xor_checksum(data: collections.abc.Iterable[int]):
     checksum = 0
     for byte in data:
         checksum ^= byte
+    if 0 <= checksum <= 0xFF:
+        return checksum
+    # only items wider than a byte, e.g. of a memoryview of another format, get here, so tuples and bytes keep the plain loop
+    view = as_buffer(data)
+    if view is data:
+        return checksum
+    checksum = 0
+    for byte in view:
+        checksum ^= byte
     return checksum
 
 
-def calc_crc16_modbus(data: collections.abc.Iterable[int]):
-    crc = 0xFFFF
-    for byte in data:
-        crc ^= byte & 0xFF
+def make_crc16_table(polynomial: int):
+    ''' the CRC of every byte value, for a reflected CRC16 of `polynomial` '''
+    table = []
+    for byte in range(256):
+        crc = byte
         for _ in range(8):
-            tmp = crc & 0x0001
-            crc >>= 1
-            if tmp:
-                crc ^= 0xA001
+            crc = (crc >> 1) ^ polynomial if crc & 0x0001 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_MODBUS_TABLE = make_crc16_table(0xA001)
+
+
+def calc_crc16_modbus(data: collections.abc.Iterable[int], crc: int = 0xFFFF):
+    ''' pass the CRC of the previous part as `crc` to continue over data in several parts '''
+    table = CRC16_MODBUS_TABLE
+    for byte in data if isinstance(data, BYTE_SEQUENCES) else as_buffer(data):
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
     return crc
 
 
@@ -26,7 +57,6 @@ def get_random_iv():
 
 
 def pad_to_multiple(data: collections.abc.Iterable[int], length: int):
-    data = bytearray(data)
-    while len(data) % length:
-        data += b'\x00'
-    return bytes(data)
+    data = bytes(data if isinstance(data, BYTE_SEQUENCES) else as_buffer(data))
+    padding = -len(data) % length
+    return data + bytes(padding) if padding else data
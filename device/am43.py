@@ -1,9 +1,14 @@
 from __future__ import annotations
 import asyncio
 import bluetooth
+import contextlib
 import json
 import collections.abc
+import math
+import time
 import crypto
+import discovery
+import publish
 
 
 class AM43(bluetooth.EventEmitter):
@@ -18,25 +23,55 @@ class AM43(bluetooth.EventEmitter):
         'position': 0xa7,
     }
     MESSAGE_MAGIC = 0x9a
+    STALENESS = {
+        'battery': 6 * 3600,
+        'illuminance': 600,
+    }
 
-    def __init__(self, client: bluetooth.Client, identifier=''):
+    def __init__(self,
+                 client: bluetooth.Client,
+                 identifier='',
+                 publish: dict | None = None,
+                 staleness: dict[str, float] | None = None,
+                 requests: dict | None = None):
+        '''
+        publish: keyword arguments of `publish.StatePublisher`, e.g. {window: 0.5, min_interval: {illuminance: 60}}
+        staleness: seconds after which a field is polled again, see `polling.Poller`
+        requests: keyword arguments of `bluetooth.Correlator`, e.g. {window: 4, timeout: 5}
+        '''
         super().__init__()
         self.client = client
+        # a reply carries the state id of the query it answers
+        self.client.correlate(AM43.CHAR_ID['state'], lambda data: data[1] if len(data) > 1 else None, **(requests or {}))
         self.identifier = identifier or f'am43_{client.address.replace(":", "").lower()}'
+        self.publish_options = publish or {}
+        self.staleness = {**AM43.STALENESS, **(staleness or {})}
+        self.updated: dict[str, float] = {}
+        # fields restored from a snapshot and not read from the device since
+        self.stale: set[str] = set()
         self.state: dict[str, int | float | None] = {
             'battery': None,
             'illuminance': None,
             'position': None,
         }
+        # position tracking of the current move, see `track_position`
+        self.target: int | None = None
+        self.moved_at = 0.0
+        self.sample: tuple[float, int] | None = None
+        self.speed: float | None = None
+        self.position_changed = asyncio.Event()
+        self.tracker: asyncio.Task | None = None
 
     async def __aenter__(self):
         await self.client.__aenter__()
-        await self.client.start_notify(AM43.CHAR_ID['state'], self.on_notify)
+        await self.client.subscribe(AM43.CHAR_ID['state'], self.on_notify)
         await self.query()
         self.emit('init')
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
+        self.untrack()
+        await self.client.unsubscribe(AM43.CHAR_ID['state'], self.on_notify)
         await self.client.__aexit__(exc_type, exc_value, traceback)
         self.emit('finalize')
 
@@ -46,9 +81,13 @@ class AM43(bluetooth.EventEmitter):
             if state_name == 'battery':
                 self.state['battery'] = data[7]
             elif state_name == 'position':
+                self.observe_position(data[5])
                 self.state['position'] = data[5]
+                self.position_changed.set()
             elif state_name == 'illuminance':
                 self.state['illuminance'] = data[4] * 12.5
+            self.updated[state_name] = time.monotonic()
+            self.stale.discard(state_name)
             self.emit('statechange', self.state)
         except (StopIteration, IndexError):
             pass
@@ -57,33 +96,110 @@ class AM43(bluetooth.EventEmitter):
         data = (AM43.MESSAGE_MAGIC, key, len(value), *value)
         return (*data, crypto.calc_xor_checksum(data))
 
-    async def query(self):
-        for state_name in self.state:
-            onstatechange = asyncio.Future()
-            self.once('statechange', onstatechange.set_result)
-            await asyncio.gather(
-                onstatechange,
-                self.client.send(AM43.CHAR_ID['state'], self.create_command(AM43.STATE_ID[state_name], 0x01)),
-            )
-
-    async def sync_position(self, position, interval=0.7, battery=90, timeout=30, tolerance=1):
-        for _ in range(int(timeout / interval)):
-            if abs(self.state['position'] - position) <= tolerance:
-                return 'success'
-            if (self.state['battery'] or 0) < battery:
-                return 'battery'
-            await asyncio.gather(
-                asyncio.sleep(interval),
-                self.client.send(AM43.CHAR_ID['state'], self.create_command(AM43.STATE_ID['position'], 0x01)),
-            )
+    async def query(self, state_names: collections.abc.Iterable[str] | None = None):
+        ''' all queries are in flight at once, `on_notify` applies the replies '''
+        async with self.client.lease():
+            await asyncio.gather(*(
+                self.client.request(AM43.CHAR_ID['state'], self.create_command(AM43.STATE_ID[state_name], 0x01), AM43.STATE_ID[state_name])
+                for state_name in state_names or self.state
+            ))
+
+    def get_stale(self, fraction: float = 1) -> list[str]:
+        now = time.monotonic()
+        return [state_name for state_name, budget in self.staleness.items() if now - self.updated.get(state_name, -math.inf) > budget * fraction]
+
+    async def poll(self, state_names: list[str]):
+        await self.query(state_names)
+
+    def get_published_state(self):
+        return {**self.state, 'stale': sorted(self.stale)} if self.stale else self.state
+
+    def dump(self) -> dict:
+        now, wall = time.monotonic(), time.time()
+        return {
+            'state': self.state,
+            'updated': {state_name: wall - (now - updated) for state_name, updated in self.updated.items()},
+            'speed': self.speed,
+        }
+
+    def restore(self, snapshot: dict) -> bool:
+        ''' restored fields keep their age, they are published as `stale` until read again '''
+        state = {state_name: value for state_name, value in (snapshot.get('state') or {}).items() if state_name in self.state and value is not None}
+        if not state:
+            return False
+        now, wall = time.monotonic(), time.time()
+        self.state.update(state)
+        self.stale = set(state)
+        self.updated.update({
+            state_name: now - (wall - updated) for state_name, updated in (snapshot.get('updated') or {}).items() if state_name in state
+        })
+        self.speed = snapshot.get('speed')
+        return True
+
+    def observe_position(self, position: int):
+        ''' learn the motor speed in percent per second from positions seen while moving '''
+        if self.sample is None:
+            return
+        then, last_position = self.sample
+        now = time.monotonic()
+        if position != last_position and position != self.target and now > then:
+            speed = abs(position - last_position) / (now - then)
+            self.speed = speed if self.speed is None else (self.speed + speed) / 2
+            self.sample = (now, position)
+
+    async def track_position(self, interval=0.7, fallback=5, battery=90, timeout=60, tolerance=1):
+        '''
+        Follow the current move until the blind reaches `self.target`.
+        Position notifications wake the tracker up, so it only polls when
+        the arrival time estimated from the motor speed passes without one, or at most every `fallback` seconds.
+        Polls are follow-ups, so they yield to commands of other devices.
+        '''
+        bluetooth.current_priority.set(bluetooth.Priority.POLL)
+        try:
+            while True:
+                position = self.state['position']
+                if position is not None and abs(position - self.target) <= tolerance:
+                    return 'success'
+                if (self.state['battery'] or 0) < battery:
+                    return 'battery'
+                if time.monotonic() - self.moved_at > timeout:
+                    return 'timeout'
+                if position is None or self.speed is None:
+                    wait = interval
+                else:
+                    wait = min(max(abs(self.target - position) / self.speed, interval), fallback)
+                self.position_changed.clear()
+                try:
+                    await asyncio.wait_for(self.position_changed.wait(), wait)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await self.client.request(
+                        AM43.CHAR_ID['state'], self.create_command(AM43.STATE_ID['position'], 0x01), AM43.STATE_ID['position'], timeout=fallback)
+        finally:
+            self.sample = None
+
+    def track(self, position: int):
+        ''' there is at most one tracker per device, a new move retargets it '''
+        self.target = position
+        self.moved_at = time.monotonic()
+        if self.sample is None and self.state['position'] is not None:
+            self.sample = (self.moved_at, self.state['position'])
+        if self.tracker and not self.tracker.done():
+            self.position_changed.set()
         else:
-            return 'timeout'
+            self.tracker = asyncio.create_task(self.track_position())
+        return self.tracker
 
-    async def move(self, position: int, timeout=60):
-        return (
-            asyncio.create_task(self.sync_position(position)),
-            await self.client.send(AM43.CHAR_ID['state'], self.create_command(AM43.STATE_ID['move'], position)),
-        )
+    def untrack(self):
+        if self.tracker:
+            self.tracker.cancel()
+            self.tracker = None
+
+    async def move(self, position: int):
+        result = await self.client.send(AM43.CHAR_ID['state'], self.create_command(AM43.STATE_ID['move'], position))
+        return (self.track(position), result)
 
     async def open(self):
         return await self.move(0)
@@ -92,77 +208,57 @@ class AM43(bluetooth.EventEmitter):
         return await self.move(100)
 
     async def stop(self):
+        self.untrack()
         return (
             asyncio.create_task(self.query()),
             await self.client.send(AM43.CHAR_ID['state'], self.create_command(AM43.STATE_ID['stop'], 0xcc)),
         )
 
     async def bindMQTT(self, mqtt, device_topic, homeassistant_discovery_topic):
-        self.on('finalize', lambda: asyncio.create_task(mqtt.publish(f'{device_topic}/availability', 'offline'.encode('utf8'), retain=False)))
-        await mqtt.publish(f'{device_topic}/availability', 'online'.encode('utf8'), retain=False)
-        self.on('statechange', lambda state: asyncio.create_task(mqtt.publish(device_topic, json.dumps(state).encode('utf8'))))
-        await mqtt.publish(device_topic, json.dumps(self.state).encode('utf8'))
-
-        device = {
-            'connections': [('bluetooth', self.client.address)],
-            'identifiers': self.identifier,
-            'manufacturer': 'Generic',
-            'model': 'AM43 Blind Drive Motor',
-            'name': self.identifier,
-        }
-        await mqtt.publish(
-            f'{homeassistant_discovery_topic}/cover/{self.identifier}/config',
-            json.dumps({
-                'availability': {
-                    'payload_available': 'online',
-                    'payload_not_available': 'offline',
-                    'topic': f'{device_topic}/availability',
-                },
-                'command_topic': f'{device_topic}/set/state',
-                'device': device,
-                'name': device["name"],
-                'payload_close': 'CLOSE',
-                'payload_open': 'OPEN',
-                'payload_stop': 'STOP',
-                'position_closed': 100,
-                'position_open': 0,
-                'position_topic': device_topic,
-                'set_position_topic': f'{device_topic}/set/position',
-                'unique_id': self.identifier,
-                'position_template': '{{value_json["position"]}}',
-            }).encode('utf8'))
-        await mqtt.publish(
-            f'{homeassistant_discovery_topic}/sensor/{self.identifier}_battery/config',
-            json.dumps({
-                'availability': {
-                    'payload_available': 'online',
-                    'payload_not_available': 'offline',
-                    'topic': f'{device_topic}/availability',
-                },
-                'device': device,
-                'device_class': 'battery',
-                'name': f'{device["name"]} battery',
-                'state_topic': device_topic,
-                'unique_id': f'{self.identifier}_battery',
-                'unit_of_measurement': '%',
-                'value_template': '{{value_json["battery"]}}',
-            }).encode('utf8'))
-        await mqtt.publish(
-            f'{homeassistant_discovery_topic}/sensor/{self.identifier}_illuminance/config',
-            json.dumps({
-                'availability': {
-                    'payload_available': 'online',
-                    'payload_not_available': 'offline',
-                    'topic': f'{device_topic}/availability',
-                },
-                'device': device,
-                'device_class': 'illuminance',
-                'name': f'{device["name"]} illuminance',
-                'state_topic': device_topic,
-                'unique_id': f'{self.identifier}_illuminance',
-                'unit_of_measurement': 'lx',
-                'value_template': '{{value_json["illuminance"]}}',
-            }).encode('utf8'))
+        self.on('finalize', lambda: mqtt.put(f'{device_topic}/availability', 'offline'.encode('utf8'), retain=False))
+        self.client.event.on('unavailable', lambda: mqtt.put(f'{device_topic}/availability', 'offline'.encode('utf8'), retain=False))
+        self.client.event.on('available', lambda: mqtt.put(f'{device_topic}/availability', 'online'.encode('utf8'), retain=False))
+        # a lazy device entered after it failed
+        self.on('init', lambda: mqtt.put(f'{device_topic}/availability', 'online'.encode('utf8'), retain=False))
+        availability = 'online' if self.client.breaker.closed else 'offline'
+        await mqtt.publish(f'{device_topic}/availability', availability.encode('utf8'), retain=False)
+        publisher = publish.StatePublisher(mqtt, device_topic, **self.publish_options)
+        self.on('statechange', lambda _: publisher.update(self.get_published_state()))
+        await publisher.publish(self.get_published_state())
+
+        device = discovery.device(self.identifier, self.client.address, manufacturer='Generic', model='AM43 Blind Drive Motor')
+        await discovery.cache.publish(mqtt, *discovery.entity(
+            homeassistant_discovery_topic, 'cover', self.identifier, device_topic, device,
+            command_topic=f'{device_topic}/set/state',
+            payload_close='CLOSE',
+            payload_open='OPEN',
+            payload_stop='STOP',
+            position_closed=100,
+            position_open=0,
+            position_topic=device_topic,
+            set_position_topic=f'{device_topic}/set/position',
+            position_template='{{value_json["position"]}}',
+        ))
+        await discovery.cache.publish(mqtt, *discovery.entity(
+            homeassistant_discovery_topic, 'sensor', f'{self.identifier}_battery', device_topic, device,
+            device_class='battery',
+            name=f'{device["name"]} battery',
+            state_topic=device_topic,
+            unit_of_measurement='%',
+            value_template='{{value_json["battery"]}}',
+        ))
+        await discovery.cache.publish(mqtt, *discovery.entity(
+            homeassistant_discovery_topic, 'sensor', f'{self.identifier}_illuminance', device_topic, device,
+            device_class='illuminance',
+            name=f'{device["name"]} illuminance',
+            state_topic=device_topic,
+            unit_of_measurement='lx',
+            value_template='{{value_json["illuminance"]}}',
+        ))
+
+    def get_command_key(self, topic, data):
+        ''' moves and stops all decide where the blind ends up, so only the latest one matters '''
+        return 'set' if topic[:1] == ['set'] else None
 
     async def handleMQTT(self, topic, data):
         if len(topic) > 0:
@@ -1,5 +1,8 @@
-import amqtt.client
+from __future__ import annotations
 import abc
+import asyncio
+
+import publish
 
 
 class BaseDevice(abc.ABC):
@@ -26,7 +29,7 @@ class BaseDevice(abc.ABC):
         pass
 
     @abc.abstractmethod
-    async def bindMQTT(self, mqtt: amqtt.client.MQTTClient, device_topic: str, homeassistant_discovery_topic: str = None) -> None:
+    async def bindMQTT(self, mqtt: publish.Outbox, device_topic: str, homeassistant_discovery_topic: str = None) -> None:
         '''
         Will be called once the mqtt client is ready.
         Add `mqtt.publish` as a device notification listener here.
@@ -48,5 +51,99 @@ class BaseDevice(abc.ABC):
         '''
         raise NotImplementedError()
 
+    def get_command_key(self, topic: list[str], data: str) -> str | None:
+        '''
+        Optional.
+        A pending command is dropped when a newer one with the same key arrives, e.g. a new position replaces a pending one.
+        None means the command never supersedes others.
+        '''
+        return None
+
+    def get_stale(self, fraction: float = 1) -> list[str]:
+        '''
+        Optional, for devices with fields to poll periodically.
+        Return the fields older than `fraction` of their staleness budget.
+        '''
+        return []
+
+    async def poll(self, fields: list[str]) -> None:
+        '''
+        Optional, see `get_stale`.
+        Read all `fields` in one pass, `polling.Poller` calls it with `bluetooth.Priority.POLL`.
+        '''
+        pass
+
+    def dump(self) -> dict:
+        '''
+        Optional, for devices with state worth keeping across restarts.
+        Return something json serializable, see `snapshot.Snapshot`.
+        '''
+        return {}
+
+    def restore(self, snapshot: dict) -> bool:
+        '''
+        Optional, see `dump`.
+        Called before `__aenter__`, return whether there was anything to restore.
+        A restored device is entered in the background, so the refresh should happen in `__aenter__`.
+        '''
+        return False
+
+
+class LazyDevice(BaseDevice):
+    '''
+    Defers `__aenter__` of the wrapped device until it is actually needed.
+    The device is registered and bound to mqtt right away, but only connects on its first command or poll.
+    '''
+
+    def __init__(self, device: BaseDevice):
+        self.device = device
+        self.active = False
+        self.lock = asyncio.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    @property
+    def identifier(self) -> str:
+        return self.device.identifier
+
+    async def __aenter__(self) -> 'LazyDevice':
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.active:
+            self.active = False
+            await self.device.__aexit__(exc_type, exc_value, traceback)
+        elif hasattr(self.device, 'emit'):
+            # never entered, but bound to mqtt all the same, e.g. to publish offline
+            self.device.emit('finalize')
+
+    async def activate(self) -> BaseDevice:
+        async with self.lock:
+            if not self.active:
+                await self.device.__aenter__()
+                self.active = True
+        return self.device
+
+    async def bindMQTT(self, mqtt: publish.Outbox, device_topic: str, homeassistant_discovery_topic: str = None) -> None:
+        return await self.device.bindMQTT(mqtt=mqtt, device_topic=device_topic, homeassistant_discovery_topic=homeassistant_discovery_topic)
+
+    async def handleMQTT(self, topic: list[str], data: str) -> None:
+        await self.activate()
+        return await self.device.handleMQTT(topic=topic, data=data)
+
+    def get_stale(self, fraction: float = 1) -> list[str]:
+        return self.device.get_stale(fraction) if hasattr(self.device, 'get_stale') else []
+
+    async def poll(self, fields: list[str]) -> None:
+        await self.activate()
+        return await self.device.poll(fields)
+
+    def dump(self) -> dict:
+        return self.device.dump() if hasattr(self.device, 'dump') else {}
+
+    def restore(self, snapshot: dict) -> bool:
+        return self.device.restore(snapshot) if hasattr(self.device, 'restore') else False
+
 
 Device = BaseDevice
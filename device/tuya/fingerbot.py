@@ -1,11 +1,26 @@
 from __future__ import annotations
 import asyncio
+import collections
+import contextlib
+import logging
+import statistics
+import time
 import bluetooth
-import json
+import log
+import discovery
 from . import util
 
+logger = logging.getLogger(__name__)
+
 
 class TuyaFingerBot(bluetooth.EventEmitter):
+    '''
+    A press needs a session, which costs two round trips after every connect and is lost on every disconnect.
+
+    1. the handshake starts as soon as a connection is established, a press joins it instead of starting another
+    2. for `keep_warm` seconds after a press, the session is kept: a status request goes out ahead of the idle timeout
+       the device drops connections after, learnt from the drops seen so far, and a dropped session is set up again right away
+    '''
     CHAR_ID = {
         'notification': bluetooth.expand_uuid('2b10'),
         'state': bluetooth.expand_uuid('2b11'),
@@ -22,7 +37,17 @@ class TuyaFingerBot(bluetooth.EventEmitter):
         'PROG': 121,
     }
 
-    def __init__(self, client: bluetooth.Client, device_id: str, uuid: str, local_key: str, down_percent: int = 80, identifier=''):
+    # a keep-alive goes out at this fraction of the idle timeout
+    KEEPALIVE_AT = 0.7
+
+    def __init__(self,
+                 client: bluetooth.Client,
+                 device_id: str,
+                 uuid: str,
+                 local_key: str,
+                 down_percent: int = 80,
+                 keep_warm: float = 30,
+                 identifier=''):
         super().__init__()
         self.client = client
         self.identifier = identifier or f'tuya_fingerbot_{client.address.replace(":", "").lower()}'
@@ -30,25 +55,89 @@ class TuyaFingerBot(bluetooth.EventEmitter):
         self.uuid = uuid.encode('ascii')
         self.local_key = local_key
         self.down_percent = down_percent
+        self.keep_warm = keep_warm
         self.session = util.TuyaSession(self.local_key)
+        self.responses = bluetooth.Correlator(lambda message: message['ack_sn'])
+        self.listener: asyncio.Task | None = None
+        self.handshake: asyncio.Task | None = None
+        self.keeper: asyncio.Task | None = None
+        self.warm_until = 0.0
+        self.last_write = 0.0
+        # seconds from the last write to a disconnect, see `get_idle_timeout`
+        self.idle_gaps: collections.deque[float] = collections.deque(maxlen=5)
+        self.dropped = asyncio.Event()
+        # the same for every press, only the session framing changes
+        self.press_command = util.encode_commands((
+            (self.ACTION['MODE'], bytes((util.TuyaDataType.ENUM, 1, 0))),
+            (self.ACTION['ARM_DOWN_PERCENT'], self.down_percent),
+            (self.ACTION['ARM_UP_PERCENT'], 0),
+            (self.ACTION['CLICK_SUSTAIN_TIME'], 0),
+            (self.ACTION['CLICK'], True),
+        ))
+        self.client.event.on('disconnect', self.reset_session)
+        # from the device info response, e.g. {device_version, protocol_version, is_bind}
+        self.info: dict = {}
 
     async def __aenter__(self):
         await self.client.__aenter__()
-        self.client.event.on('disconnect', lambda: setattr(self, 'session', util.TuyaSession(self.local_key)))
-        asyncio.create_task(self.listen_notification())
+        self.listener = asyncio.create_task(self.listen_notification())
+        # only once notifications are listened to, the first connect happened above
+        self.client.event.on('connect', self.warm_up)
+        self.warm_up()
         self.emit('init')
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
+        self.client.event.remove_listener('connect', self.warm_up)
+        for task in (self.listener, self.handshake, self.keeper):
+            if task:
+                task.cancel()
+        self.listener = self.handshake = self.keeper = None
         await self.client.__aexit__(exc_type, exc_value, traceback)
         self.emit('finalize')
 
+    def reset_session(self):
+        if self.client.disconnection:
+            # evicted for another device, do not take the slot back
+            self.warm_until = 0.0
+        elif self.listener and self.last_write:
+            # dropped by the device
+            self.idle_gaps.append(time.monotonic() - self.last_write)
+        self.session = util.TuyaSession(self.local_key)
+        self.dropped.set()
+
+    def get_idle_timeout(self) -> float | None:
+        ''' how long the device keeps an idle connection, None until it dropped one '''
+        return statistics.median(self.idle_gaps) if self.idle_gaps else None
+
+    def warm_up(self):
+        ''' start the handshake of a new connection in the background '''
+        asyncio.create_task(self.sync_session_quietly())
+
+    async def sync_session_quietly(self):
+        ''' only on an established connection and an idle adapter, it must not cause connects of its own '''
+        if not self.client.is_connected or self.client.disconnection or self.client.concurrency.busy or self.session.is_ready():
+            return
+        bluetooth.current_priority.set(bluetooth.Priority.KEEPALIVE)
+        try:
+            await self.sync_session()
+        except Exception as error:
+            logger.debug('tuya.fingerbot.TuyaFingerBot.warm_up %s deferred because: %r', self.identifier, error)
+
     async def listen_notification(self):
         stream = util.map_stream(self.client.recv_stream_opportunistic(TuyaFingerBot.CHAR_ID['notification']), lambda data: data[1])
         async for message_raw in util.merge_packets(stream):
-            message = util.parse_message(message_raw, self.session)
+            try:
+                message = util.parse_message(message_raw, self.session)
+            except Exception as error:
+                # e.g. a frame of a session lost to a reconnect, the requests waiting are answered by the next frames or time out
+                logger.warning('tuya.fingerbot.TuyaFingerBot.listen_notification %s skipped a frame because: %r', self.identifier, error)
+                continue
+            self.responses.feed(message)
             code = message['code']
-            print(f'<7>listen_notification {self.identifier} received {str(code)} {message["data"].hex("-")}')
+            logger.debug('listen_notification %s received %s %s', self.identifier, code, log.Hex(message['data']))
+            if code == util.TuyaCode.FUN_SENDER_DEVICE_INFO:
+                self.info = {key: message[key] for key in ('device_version', 'protocol_version', 'is_bind')}
             if message.get('update_session', False):
                 self.emit('update_session')
             elif code == util.TuyaCode.FUN_SENDER_PAIR:
@@ -57,60 +146,100 @@ class TuyaFingerBot(bluetooth.EventEmitter):
     async def sync_session(self):
         '''
         Tuya devices will disconnect from their side after a short time.
-        On reconnect:
-        1. need to redo start_notify
-        2. need to get a new session
+        On reconnect the client restores notifications, but a new session is needed.
+        Concurrent callers share one handshake.
         '''
-        if self.session.is_ready():
+        if self.session.is_ready() and self.client.is_connected:
             return
-        await asyncio.gather(self.once_async('update_session'), self.send_request(util.create_device_info_request(self.session)))
-        await asyncio.gather(self.once_async('paired'),
-                             self.send_request(util.create_pair_request(self.session, uuid=self.uuid, device_id=self.device_id)))
+        if not self.handshake or self.handshake.done():
+            self.handshake = asyncio.create_task(self.shake_hands())
+        await asyncio.shield(self.handshake)
+
+    async def shake_hands(self):
+        async with self.client.lease():
+            if self.session.is_ready():
+                return
+            await self.request(util.create_device_info_request(self.session))
+            await self.request(util.create_pair_request(self.session, uuid=self.uuid, device_id=self.device_id))
+
+    async def keep_session(self):
+        ''' until `warm_until`, see the class docstring '''
+        bluetooth.current_priority.set(bluetooth.Priority.KEEPALIVE)
+        while time.monotonic() < self.warm_until:
+            try:
+                if not self.client.is_connected or not self.session.is_ready():
+                    if self.client.concurrency.busy:
+                        await asyncio.sleep(1)
+                    else:
+                        await self.sync_session()
+                    continue
+                idle = self.get_idle_timeout()
+                due = min(self.last_write + idle * self.KEEPALIVE_AT if idle else self.warm_until, self.warm_until)
+                self.dropped.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.dropped.wait(), due - time.monotonic())
+                    continue
+                if idle and time.monotonic() < self.warm_until:
+                    async with self.client.lease():
+                        await self.request(util.create_status_request(self.session))
+            except Exception as error:
+                logger.debug('tuya.fingerbot.TuyaFingerBot.keep_session %s retry because: %r', self.identifier, error)
+                await asyncio.sleep(3)
+
+    async def request(self, request: bytes):
+        ''' send and wait for the reply, `request` must be the last message created in this session '''
+        return await self.responses.request(self.session.last_sn, lambda: self.send_request(request))
 
     async def send_request(self, request: bytes):
-        for packet in util.split_packets(request):
-            await self.client.send(TuyaFingerBot.CHAR_ID['state'], packet)
+        ''' as few packets as the MTU of the connection allows, all over the same connection '''
+        async with self.client.lease():
+            for packet in util.split_packets(request, self.client.write_size):
+                await self.client.send(TuyaFingerBot.CHAR_ID['state'], packet)
+            self.last_write = time.monotonic()
+
+    def dump(self) -> dict:
+        return {'info': self.info}
+
+    def restore(self, snapshot: dict) -> bool:
+        self.info = snapshot.get('info') or {}
+        return bool(self.info)
 
     async def press(self):
-        await self.sync_session()
-        await self.send_request(
-            util.create_command_request(self.session, (
-                (self.ACTION['MODE'], bytes((util.TuyaDataType.ENUM, 1, 0))),
-                (self.ACTION['ARM_DOWN_PERCENT'], self.down_percent),
-                (self.ACTION['ARM_UP_PERCENT'], 0),
-                (self.ACTION['CLICK_SUSTAIN_TIME'], 0),
-                (self.ACTION['CLICK'], True),
-            )))
+        # one connection for the handshake and the command, the session is lost on disconnect
+        async with self.client.lease():
+            await self.sync_session()
+            await self.send_request(util.create_command_request(self.session, self.press_command))
+        if self.keep_warm:
+            self.warm_until = time.monotonic() + self.keep_warm
+            if not self.keeper or self.keeper.done():
+                self.keeper = asyncio.create_task(self.keep_session())
 
     async def bindMQTT(self, mqtt, device_topic: str, homeassistant_discovery_topic: str = None) -> None:
-        self.on('finalize', lambda: asyncio.create_task(mqtt.publish(f'{device_topic}/availability', 'offline'.encode('utf8'), retain=False)))
-        await mqtt.publish(f'{device_topic}/availability', 'online'.encode('utf8'), retain=False)
-
-        device = {
-            'connections': [('bluetooth', self.client.address)],
-            'identifiers': self.identifier,
-            'manufacturer': 'Adaprox',
-            'model': 'Fingerbot Plus',
-            'name': self.identifier,
-        }
-        await mqtt.publish(
-            f'{homeassistant_discovery_topic}/button/{self.identifier}/config',
-            json.dumps({
-                'availability': {
-                    'payload_available': 'online',
-                    'payload_not_available': 'offline',
-                    'topic': f'{device_topic}/availability',
-                },
-                'command_topic': f'{device_topic}/set/action',
-                'device': device,
-                'name': device["name"],
-                'unique_id': self.identifier,
-            }).encode('utf8'))
+        self.on('finalize', lambda: mqtt.put(f'{device_topic}/availability', 'offline'.encode('utf8'), retain=False))
+        self.client.event.on('unavailable', lambda: mqtt.put(f'{device_topic}/availability', 'offline'.encode('utf8'), retain=False))
+        self.client.event.on('available', lambda: mqtt.put(f'{device_topic}/availability', 'online'.encode('utf8'), retain=False))
+        # a lazy device entered after it failed
+        self.on('init', lambda: mqtt.put(f'{device_topic}/availability', 'online'.encode('utf8'), retain=False))
+        availability = 'online' if self.client.breaker.closed else 'offline'
+        await mqtt.publish(f'{device_topic}/availability', availability.encode('utf8'), retain=False)
+
+        device = discovery.device(self.identifier, self.client.address, manufacturer='Adaprox', model='Fingerbot Plus')
+        if self.info:
+            device['sw_version'] = self.info['device_version']
+        await discovery.cache.publish(mqtt, *discovery.entity(
+            homeassistant_discovery_topic, 'button', self.identifier, device_topic, device,
+            command_topic=f'{device_topic}/set/action',
+        ))
+
+    def get_command_key(self, topic: list[str], data: str) -> str | None:
+        ''' every press counts, but one pending ping is enough '''
+        return 'ping' if topic == ['ping'] else None
 
     async def handleMQTT(self, topic: list[str], data: str) -> None:
         if topic == ['set', 'action'] and data != None:
             return await self.press()
         elif topic == ['ping'] and data != None:
+            bluetooth.current_priority.set(bluetooth.Priority.KEEPALIVE)
             return await self.sync_session()
 
 
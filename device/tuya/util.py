@@ -1,5 +1,7 @@
 import crypto
 import hashlib
+import log
+import logging
 from Crypto.Cipher import AES
 from struct import pack, unpack
 from enum import IntEnum, Enum
@@ -7,6 +9,8 @@ import itertools
 import typing
 import time
 
+logger = logging.getLogger(__name__)
+
 # see https://github.com/redphx/poc-tuya-ble-fingerbot/blob/main/pyfingerbot/__init__.py
 # and
 # https://developer.tuya.com/en/docs/iot/mini-program-integration-documents?id=Ka75d8cadotgh
@@ -34,6 +38,8 @@ class TuyaSession():
     def __init__(self, local_key: str) -> None:
         self.login_key = local_key[0:6].encode('ascii')
         self.sn_counter = itertools.count(1)
+        # sn of the last message created, replies carry it as their ack_sn
+        self.last_sn = 0
         self.keys = {4: hashlib.md5(self.login_key).digest()}
 
     def __getitem__(self, data: int) -> bytes:
@@ -47,36 +53,50 @@ class TuyaSession():
 
 
 def create_message(session: TuyaSession, code: int, data: bytes, security_flag: int = 5, ack_sn: int = 0):
-    header = pack('>IIHH', next(session.sn_counter), ack_sn, code, len(data))
-    footer = pack('>H', crypto.calc_crc16_modbus(header + data))
-    cleartext = crypto.pad_to_multiple(header + data + footer, 16)
-    print(f'<7>create_message {cleartext.hex("-")}')
+    session.last_sn = next(session.sn_counter)
+    header = pack('>IIHH', session.last_sn, ack_sn, code, len(data))
+    footer = pack('>H', crypto.calc_crc16_modbus(data, crypto.calc_crc16_modbus(header)))
+    cleartext = crypto.pad_to_multiple(b''.join((header, data, footer)), 16)
+    logger.debug('create_message %s', log.Hex(cleartext))
     security_flag_byte = pack('>B', security_flag)
     iv = crypto.get_random_iv()
     encrypted = AES.new(session[security_flag], AES.MODE_CBC, iv).encrypt(cleartext)
     return security_flag_byte + iv + encrypted
 
 
-def split_packets(message: bytes):
+# the largest write of the minimum ATT MTU of 23
+DEFAULT_PACKET_SIZE = 20
+
+
+def split_packets(message: bytes, packet_size: int = DEFAULT_PACKET_SIZE):
+    ''' `packet_size` is the largest write of the connection, see `bluetooth.Client.write_size` '''
     PROTOCOL_VERSION = 2 << 4
-    GATT_MTU = 20
     offset = 0
     for packet_number in itertools.count():
-        header = pack('>B', packet_number)
+        header = write_varint(packet_number)
         if packet_number == 0:
-            header += pack('>BB', len(message), PROTOCOL_VERSION)
-        body = message[offset:offset + GATT_MTU - len(header)]
+            header += write_varint(len(message)) + pack('>B', PROTOCOL_VERSION)
+        body = message[offset:offset + packet_size - len(header)]
         yield header + body
         offset += len(body)
         if (offset >= len(message)):
             break
 
 
+def write_varint(value: int):
+    data = bytearray()
+    while value > 0b0111_1111:
+        data.append(value & 0b0111_1111 | 0b1000_0000)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
 def read_varint(data: bytes, offset: int):
     ret = 0
     i = 0
     for i, b in enumerate(data[offset:offset + 4]):
-        ret |= b << (i * 7)
+        ret |= (b & 0b0111_1111) << (i * 7)
         if b & 0b1000_0000 == 0:
             return ret, i + 1
     return ret, i
@@ -88,6 +108,10 @@ async def map_stream(stream, func):
 
 
 async def merge_packets(stream: typing.AsyncGenerator[bytes, None]):
+    '''
+    Packets may be of any size up to the MTU, a message is only yielded if all its packets arrived in order.
+    A packet out of order or overflowing the announced length drops the message.
+    '''
     message_length = None
     last_packet_number = None
     buffer = None
@@ -103,11 +127,22 @@ async def merge_packets(stream: typing.AsyncGenerator[bytes, None]):
             offset += 1
             last_packet_number = None
             buffer = bytearray()
-        if last_packet_number == None or packet_number > last_packet_number:
-            buffer += packet[offset:]
-            last_packet_number = packet_number
-            if len(buffer) == message_length:
-                yield buffer
+        if buffer is not None and packet_number == last_packet_number:
+            # a repeated packet
+            continue
+        if buffer is None or packet_number != (-1 if last_packet_number is None else last_packet_number) + 1:
+            if buffer is not None:
+                logger.warning('merge_packets dropped a message because packet %d follows %s', packet_number, last_packet_number)
+            buffer = None
+            continue
+        buffer += packet[offset:]
+        last_packet_number = packet_number
+        if len(buffer) > message_length:
+            logger.warning('merge_packets dropped a message because it exceeds its length %d', message_length)
+            buffer = None
+        elif len(buffer) == message_length:
+            yield buffer
+            buffer = None
 
 
 def parse_device_info(data: bytes):
@@ -130,7 +165,7 @@ def parse_message(message: bytes, session: TuyaSession, update_session=True):
     cleartext = AES.new(session[security_flag], AES.MODE_CBC, iv).decrypt(encrypted)
     sn, ack_sn, code, length = unpack('>IIHH', cleartext[:12])
     data = cleartext[12:12 + length]
-    ret = {'code': code, 'data': data}
+    ret = {'code': code, 'data': data, 'sn': sn, 'ack_sn': ack_sn}
     try:
         ret['code'] = TuyaCode(code)
     except ValueError:
@@ -159,7 +194,17 @@ def create_time_message(session: TuyaSession):
     return create_message(session=session, code=TuyaCode.FUN_RECEIVE_TIME1_REQ, data=data, security_flag=5)
 
 
-def create_command_request(session: TuyaSession, commands: list):
+def create_status_request(session: TuyaSession):
+    return create_message(session=session, code=TuyaCode.FUN_SENDER_DEVICE_STATUS, data=bytes(), security_flag=5)
+
+
+def create_command_request(session: TuyaSession, commands: typing.Union[list, bytes]):
+    ''' `commands` as `(dp, value)` pairs or already encoded, see `encode_commands` '''
+    data = commands if isinstance(commands, bytes) else encode_commands(commands)
+    return create_message(session=session, code=TuyaCode.FUN_SENDER_DPS, data=data, security_flag=5)
+
+
+def encode_commands(commands: list) -> bytes:
     data = bytearray()
     for key, value, in commands:
         data += pack('>B', int(key))
@@ -173,4 +218,4 @@ def create_command_request(session: TuyaSession, commands: list):
             data += pack('>BBB', TuyaDataType.ENUM, 1, int(value))
         elif type(value) == bytes:
             data += value
-    return create_message(session=session, code=TuyaCode.FUN_SENDER_DPS, data=data, security_flag=5)
+    return bytes(data)
@@ -0,0 +1,105 @@
+'''
+Home Assistant mqtt discovery.
+
+`device` and `entity` build the discovery configs shared by all device types,
+`cache` only publishes the configs that changed since they were last published to the same broker.
+'''
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+
+import publish
+
+logger = logging.getLogger(__name__)
+
+
+def device(identifier: str, address: str, manufacturer: str, model: str):
+    return {
+        'connections': [('bluetooth', address)],
+        'identifiers': identifier,
+        'manufacturer': manufacturer,
+        'model': model,
+        'name': identifier,
+    }
+
+
+def entity(homeassistant_discovery_topic: str, component: str, unique_id: str, device_topic: str, device: dict, **config):
+    ''' returns the discovery topic and config of an entity available under `{device_topic}/availability` '''
+    return f'{homeassistant_discovery_topic}/{component}/{unique_id}/config', {
+        'availability': {
+            'payload_available': 'online',
+            'payload_not_available': 'offline',
+            'topic': f'{device_topic}/availability',
+        },
+        'device': device,
+        'name': device['name'],
+        'unique_id': unique_id,
+        **config,
+    }
+
+
+class DiscoveryCache:
+    '''
+    Remembers a fingerprint of every retained discovery config, optionally in a file across restarts.
+    Fingerprints are only valid for the broker they were published to,
+    and only recorded once the broker took the config, the file is saved when none is left waiting.
+    '''
+
+    def __init__(self):
+        self.path: str | None = None
+        self.server: str | None = None
+        self.fingerprints: dict[str, str] = {}
+        # topic -> fingerprint of a config queued but not taken by the broker yet
+        self.unconfirmed: dict[str, str] = {}
+        self.payloads: dict[str, bytes] = {}
+
+    def load(self, path: str | None, server: str):
+        self.path = path
+        self.server = server
+        try:
+            with open(path) as file:
+                cache = json.load(file)
+            if cache['server'] == server:
+                self.fingerprints = cache['fingerprints']
+        except (TypeError, OSError, ValueError, KeyError):
+            self.fingerprints = {}
+
+    def save(self):
+        ''' a file that cannot be written only costs republishing on the next start '''
+        if not self.path:
+            return
+        try:
+            with open(f'{self.path}.tmp', 'w') as file:
+                json.dump({'server': self.server, 'fingerprints': self.fingerprints}, file)
+            os.replace(f'{self.path}.tmp', self.path)
+        except OSError as error:
+            logger.warning('discovery.DiscoveryCache.save %s failed because: %r', self.path, error)
+            with contextlib.suppress(OSError):
+                os.remove(f'{self.path}.tmp')
+
+    async def publish(self, mqtt: publish.Outbox, topic: str, config: dict):
+        payload = json.dumps(config, sort_keys=True).encode('utf8')
+        fingerprint = hashlib.sha1(payload).hexdigest()
+        self.payloads[topic] = payload
+        if self.fingerprints.get(topic) != fingerprint and self.unconfirmed.get(topic) != fingerprint:
+            self.unconfirmed[topic] = fingerprint
+            await mqtt.publish(topic, payload, done=lambda: self.confirm(topic, fingerprint))
+
+    def confirm(self, topic: str, fingerprint: str):
+        self.fingerprints[topic] = fingerprint
+        if self.unconfirmed.get(topic) == fingerprint:
+            del self.unconfirmed[topic]
+            if not self.unconfirmed:
+                self.save()
+
+    async def republish(self, mqtt: publish.Outbox):
+        ''' e.g. when home assistant restarts and asks for discovery again '''
+        for topic, payload in self.payloads.items():
+            await mqtt.publish(topic, payload)
+
+
+cache = DiscoveryCache()
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import collections.abc
+import logging
+
+from device.interface import BaseDevice
+
+logger = logging.getLogger(__name__)
+
+
+class CommandQueue:
+    '''
+    Runs the mqtt commands of one device in order, one at a time.
+
+    1. a new command supersedes the pending ones with the same key, see `BaseDevice.get_command_key`
+    2. no more than `depth` commands are pending, further ones are dropped until the device catches up
+    3. commands of a group go through the queues of its members, see `run`
+    '''
+
+    def __init__(self, device: BaseDevice, depth: int = 8):
+        self.device = device
+        self.depth = depth
+        # (key, topic, data, done)
+        self.pending: collections.deque[tuple[str | None, list[str], str, asyncio.Future | None]] = collections.deque()
+        self.worker: asyncio.Task | None = None
+
+    def submit(self, topic: list[str], data: str, done: asyncio.Future | None = None):
+        ''' `done` is set to whether the command ran, it did not if superseded or dropped '''
+        key = self.device.get_command_key(topic, data) if hasattr(self.device, 'get_command_key') else None
+        if key is not None:
+            superseded = [command for command in self.pending if command[0] == key]
+            for command in superseded:
+                self.pending.remove(command)
+                self.settle(command[3], False)
+        if len(self.pending) >= self.depth:
+            logger.warning('dispatch.CommandQueue.submit %s dropped %s because the queue is full', self.device.identifier, '/'.join(topic))
+            self.settle(done, False)
+            return False
+        self.pending.append((key, topic, data, done))
+        if not self.worker or self.worker.done():
+            self.worker = asyncio.create_task(self.work())
+        return True
+
+    async def run(self, topic: list[str], data: str) -> bool:
+        ''' submits and waits for the command, whether it ran '''
+        done = asyncio.get_running_loop().create_future()
+        self.submit(topic, data, done)
+        return await done
+
+    def clear(self):
+        ''' drops the pending commands '''
+        while self.pending:
+            self.settle(self.pending.popleft()[3], False)
+
+    @staticmethod
+    def settle(done: asyncio.Future | None, ran: bool):
+        if done and not done.done():
+            done.set_result(ran)
+
+    async def work(self):
+        while self.pending:
+            _, topic, data, done = self.pending.popleft()
+            try:
+                # a task of its own, so that context such as `bluetooth.current_priority` does not leak into the next command
+                await asyncio.create_task(self.device.handleMQTT(topic=topic, data=data))
+            except Exception as error:
+                logger.error('dispatch.CommandQueue.work %s %s failed because: %r', self.device.identifier, '/'.join(topic), error)
+            finally:
+                self.settle(done, True)
+
+
+class Router:
+    '''
+    Routes mqtt topics to handlers through a trie of topic levels, built once per route instead of per message.
+
+    1. a route is a topic filter, `+` matches one level and a trailing `#` any number of levels, including none
+    2. a literal level takes precedence over `+`, which takes precedence over `#`
+    3. handlers are called with the levels the wildcards matched and the payload
+    '''
+
+    class Node:
+        __slots__ = ('children', 'handler')
+
+        def __init__(self):
+            self.children: dict[str, Router.Node] = {}
+            self.handler: collections.abc.Callable[[list[str], str], None] | None = None
+
+    def __init__(self):
+        self.root = Router.Node()
+
+    def add(self, route: str, handler: collections.abc.Callable[[list[str], str], None]):
+        node = self.root
+        for level in route.split('/'):
+            node = node.children.setdefault(level, Router.Node())
+        node.handler = handler
+
+    def remove(self, route: str):
+        ''' removes the handler of `route` and prunes the levels no other route needs '''
+        path = [self.root]
+        levels = route.split('/')
+        for level in levels:
+            if level not in path[-1].children:
+                return
+            path.append(path[-1].children[level])
+        path[-1].handler = None
+        for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+            if node.handler or node.children:
+                break
+            del parent.children[level]
+
+    def match(self, topic: str) -> tuple[collections.abc.Callable[[list[str], str], None], list[str]] | None:
+        ''' the handler of `topic` and the levels its wildcards matched '''
+        return self.walk(self.root, topic.split('/'), 0)
+
+    def walk(self, node: Router.Node, levels: list[str], index: int):
+        if index == len(levels):
+            if node.handler:
+                return node.handler, []
+            tail = node.children.get('#')
+            return (tail.handler, []) if tail and tail.handler else None
+        child = node.children.get(levels[index])
+        if child and (matched := self.walk(child, levels, index + 1)):
+            return matched
+        child = node.children.get('+')
+        if child and (matched := self.walk(child, levels, index + 1)):
+            return matched[0], [levels[index], *matched[1]]
+        tail = node.children.get('#')
+        if tail and tail.handler:
+            return tail.handler, levels[index:]
+        return None
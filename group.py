@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import collections.abc
+import logging
+import statistics
+
+import bluetooth
+import discovery
+import dispatch
+import publish
+from device.interface import BaseDevice
+
+logger = logging.getLogger(__name__)
+
+
+class Group(BaseDevice):
+    '''
+    A set of devices behind one mqtt topic and one Home Assistant entity.
+
+    A command is planned as a batch:
+    1. members already connected go first, all at once
+    2. then the rest, in waves as large as the capacity of their adapter
+    3. each member lets go of its connection as soon as its command is written
+
+    A member runs the command through its own queue, in order with its other commands, see `dispatch.CommandQueue`.
+    '''
+
+    def __init__(self,
+                 identifier: str,
+                 members: list[BaseDevice],
+                 queues: dict[str, dispatch.CommandQueue],
+                 owns: collections.abc.Callable[[BaseDevice], bool] | None = None):
+        '''
+        `queues` are the command queues by identifier, looked up at each command as they are replaced on reload.
+        `owns` limits commands to the members this bridge is responsible for, see `cluster.Cluster`.
+        '''
+        self.group_identifier = identifier
+        self.members = members
+        self.queues = queues
+        self.owns = owns or (lambda member: True)
+        self.listeners: list[tuple[BaseDevice, object]] = []
+
+    @property
+    def identifier(self) -> str:
+        return self.group_identifier
+
+    async def __aenter__(self) -> 'Group':
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        ''' detaches from the members, e.g. when the group is rebuilt on reload '''
+        for member, listener in self.listeners:
+            member.remove_listener('statechange', listener)
+        self.listeners = []
+
+    def get_state(self):
+        positions = [member.state['position'] for member in self.members if getattr(member, 'state', {}).get('position') is not None]
+        return {'position': round(statistics.mean(positions)) if positions else None}
+
+    async def bindMQTT(self, mqtt, device_topic: str, homeassistant_discovery_topic: str = None) -> None:
+        await mqtt.publish(f'{device_topic}/availability', 'online'.encode('utf8'), retain=False)
+        device = {
+            'identifiers': self.identifier,
+            'manufacturer': 'ble2mqtt',
+            'model': 'Group',
+            'name': self.identifier,
+        }
+        if all(hasattr(member, 'press') for member in self.members):
+            await discovery.cache.publish(mqtt, *discovery.entity(
+                homeassistant_discovery_topic, 'button', self.identifier, device_topic, device,
+                command_topic=f'{device_topic}/set/action',
+            ))
+            return
+        publisher = publish.StatePublisher(mqtt, device_topic)
+        for member in self.members:
+            if hasattr(member, 'state'):
+                listener = member.on('statechange', lambda _: publisher.update(self.get_state()))
+                self.listeners.append((member, listener))
+        await publisher.publish(self.get_state())
+        await discovery.cache.publish(mqtt, *discovery.entity(
+            homeassistant_discovery_topic, 'cover', self.identifier, device_topic, device,
+            command_topic=f'{device_topic}/set/state',
+            payload_close='CLOSE',
+            payload_open='OPEN',
+            payload_stop='STOP',
+            position_closed=100,
+            position_open=0,
+            position_topic=device_topic,
+            set_position_topic=f'{device_topic}/set/position',
+            position_template='{{value_json["position"]}}',
+        ))
+
+    def get_command_key(self, topic: list[str], data: str) -> str | None:
+        return 'set' if topic[:1] == ['set'] else None
+
+    async def run(self, member: BaseDevice, topic: list[str], data: str):
+        queue = self.queues.get(member.identifier)
+        if not queue:
+            logger.warning('group.Group.run %s skipped %s because it has no queue', self.identifier, member.identifier)
+            return
+        try:
+            if not await queue.run(topic, data):
+                logger.info('group.Group.run %s %s superseded or dropped', self.identifier, member.identifier)
+        finally:
+            member.client.release()
+
+    async def run_waves(self, concurrency: bluetooth.Concurrency, members: list[BaseDevice], topic: list[str], data: str):
+        for offset in range(0, len(members), concurrency.capacity):
+            await asyncio.gather(*(self.run(member, topic, data) for member in members[offset:offset + concurrency.capacity]))
+
+    async def handleMQTT(self, topic: list[str], data: str) -> None:
+        members = [member for member in self.members if self.owns(member)]
+        connected = [member for member in members if member.client.is_connected]
+        await asyncio.gather(*(self.run(member, topic, data) for member in connected))
+        waves: collections.defaultdict[bluetooth.Concurrency, list[BaseDevice]] = collections.defaultdict(list)
+        for member in members:
+            if member not in connected:
+                waves[member.client.concurrency].append(member)
+        await asyncio.gather(*(self.run_waves(concurrency, members, topic, data) for concurrency, members in waves.items()))
+
+
+def get_groups(configuration,
+               devices_reg: dict[str, BaseDevice],
+               queues: dict[str, dispatch.CommandQueue],
+               owns: collections.abc.Callable[[BaseDevice], bool] | None = None) -> dict[str, Group]:
+    '''
+    `groups` maps a group identifier to `{devices: [...]}`,
+    where devices are listed by identifier or MAC address.
+    '''
+    devices = {**{device.client.address.upper(): device for device in devices_reg.values()}, **devices_reg}
+    groups = {}
+    for identifier, group_config in (configuration.get('groups') or {}).items():
+        members = []
+        for member in group_config['devices']:
+            if member in devices or member.upper() in devices:
+                members.append(devices.get(member) or devices[member.upper()])
+            else:
+                logger.warning('group.get_groups %s ignores unknown device %s', identifier, member)
+        groups[identifier] = Group(identifier, members, queues, owns)
+    return groups
@@ -0,0 +1,140 @@
+'''
+Logging on top of the standard `logging`, configured by the `logging` section of the configuration.
+
+Every module logs to `logging.getLogger(__name__)` with %-style arguments,
+so a message below the level of its module is never formatted, see `Hex` for byte dumps.
+`journal` prefixes lines with their syslog priority for journald, `json` writes one object per line.
+'''
+from __future__ import annotations
+
+import json
+import logging
+import sys
+import time
+
+NOTICE = 25
+logging.addLevelName(NOTICE, 'NOTICE')
+
+# syslog priority of a level, see sd-daemon(3)
+PRIORITIES = {logging.DEBUG: 7, logging.INFO: 6, NOTICE: 5, logging.WARNING: 4, logging.ERROR: 3, logging.CRITICAL: 2}
+
+
+def priority(levelno: int) -> int:
+    return next((value for level, value in sorted(PRIORITIES.items(), reverse=True) if levelno >= level), 7)
+
+
+class Hex:
+    ''' `data` as dash separated hex, only built when the message is formatted '''
+
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __str__(self):
+        return self.data.hex('-')
+
+
+class RateLimit(logging.Filter):
+    '''
+    Lets at most `burst` records of the same message through every `interval` seconds, e.g. a retry loop.
+    Records are told apart by logger and formatted message, so that messages about different devices never suppress each other.
+    The first record through after a drop carries the count of the dropped ones as `suppressed`.
+    '''
+
+    def __init__(self, interval: float = 10, burst: int = 5, size: int = 1024):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        # windows kept before expired ones are forgotten
+        self.size = size
+        # (logger, message) -> [window start, passed, suppressed]
+        self.windows: dict[tuple[str, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        if len(self.windows) >= self.size:
+            self.windows = {key: window for key, window in self.windows.items() if window[2] or now - window[0] < self.interval}
+        window = self.windows.setdefault((record.name, record.getMessage()), [now, 0, 0])
+        if now - window[0] >= self.interval:
+            window[0], window[1] = now, 0
+        if window[1] >= self.burst:
+            window[2] += 1
+            return False
+        window[1] += 1
+        if window[2]:
+            record.suppressed, window[2] = window[2], 0
+        return True
+
+
+class Formatter(logging.Formatter):
+    ''' tells how many records `RateLimit` dropped before this one '''
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        if getattr(record, 'suppressed', 0):
+            message += f' ({record.suppressed} similar suppressed)'
+        return message
+
+
+class JournalFormatter(Formatter):
+    ''' `<priority>message`, journald takes the priority from the prefix and adds the time itself '''
+
+    def format(self, record: logging.LogRecord) -> str:
+        return f'<{priority(record.levelno)}>{super().format(record)}'
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': record.created,
+            'priority': priority(record.levelno),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+FORMATTERS = {
+    'journal': JournalFormatter,
+    'json': JsonFormatter,
+    'plain': lambda: Formatter('%(asctime)s %(levelname)s %(message)s'),
+}
+
+# libraries chatty at info, unless `levels` says otherwise
+LIBRARY_LEVELS = {'amqtt': 'warning', 'transitions': 'warning'}
+
+handler: logging.Handler | None = None
+# loggers given a level of their own by the last `configure`
+levels: list[str] = []
+
+
+def configure(configuration: dict | None):
+    '''
+    (Re)configures the root logger, `configuration` is the `logging` section:
+    `level`, `levels` by module, `format` and `rate_limit` as `{interval, burst}` or null.
+    '''
+    global handler, levels
+    configuration = configuration or {}
+    root = logging.getLogger()
+    if handler:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(FORMATTERS[configuration.get('format', 'journal')]())
+    rate_limit = configuration.get('rate_limit', {})
+    if rate_limit is not None:
+        handler.addFilter(RateLimit(**rate_limit))
+    root.addHandler(handler)
+    root.setLevel(str(configuration.get('level', 'info')).upper())
+    for name in levels:
+        logging.getLogger(name).setLevel(logging.NOTSET)
+    configured = LIBRARY_LEVELS | (configuration.get('levels') or {})
+    levels = list(configured)
+    for name, level in configured.items():
+        logging.getLogger(name).setLevel(str(level).upper())
@@ -1,44 +1,82 @@
+from __future__ import annotations
+
 import argparse
 import asyncio
+import collections.abc
 import contextlib
-import importlib
+import json
+import logging
 import signal
+import socket
 
 import amqtt.client
 import amqtt.mqtt.constants
 import furl
 import yaml
 
-import bluetooth
+import cluster
+import discovery
+import dispatch
+import group
+import log
+import polling
+import publish
+import registry
+import snapshot
+import tracing
 from device.interface import BaseDevice
 
+logger = logging.getLogger('main')
 
-@contextlib.asynccontextmanager
-async def get_devices_reg(configuration):
-    devices_reg: dict[str, BaseDevice] = {}
-    concurrency = bluetooth.Concurrency(configuration['controller'].get('capacity'))
-    async with contextlib.AsyncExitStack() as stack:
-        for address in configuration['devices']:
-            client = bluetooth.Client(address, concurrency)
-            device_type = configuration['devices'][address]['type']
-            device_config = dict(configuration['devices'][address])
-            device_config.pop('type')
-            device: BaseDevice = importlib.import_module(f'device.{device_type}').Device(client, **device_config)
-            devices_reg[device.identifier] = await stack.enter_async_context(device)
-        yield devices_reg
+# topics under a device or group that carry commands, the bridge subscribes to nothing else of theirs
+COMMAND_TOPICS = ('set/#', 'get/#', 'ping')
+
+
+class MQTTClient(amqtt.client.MQTTClient):
+    '''
+    Keeps the topics it is subscribed to, the one record of what the bridge listens to:
+    the command topics of the devices and groups it routes, see `COMMAND_TOPICS`, and its bridge topics.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # topic filter -> qos
+        self.subscriptions: dict[str, int] = {}
+
+    async def subscribe(self, topics: list[tuple[str, int]]):
+        self.subscriptions.update(topics)
+        return await super().subscribe(topics)
+
+    async def unsubscribe(self, topics: list[str]):
+        for topic in topics:
+            self.subscriptions.pop(topic, None)
+        await super().unsubscribe(topics)
+
+    async def reconnect(self, cleansession: bool | None = None):
+        ''' amqtt reconnects with a clean session, the broker forgot the subscriptions or is a new one '''
+        code = await super().reconnect(cleansession)
+        if self.subscriptions:
+            try:
+                await super().subscribe(list(self.subscriptions.items()))
+                logger.info('main.MQTTClient.reconnect subscribed again to %d topics', len(self.subscriptions))
+            except Exception as error:
+                logger.error('main.MQTTClient.reconnect failed to subscribe again because: %r', error)
+        return code
 
 
 @contextlib.asynccontextmanager
 async def get_mqtt(configuration):
-    mqtt = amqtt.client.MQTTClient(client_id=configuration['mqtt'].get('client_id'), config={'default_retain': True})
+    # publishes wait for a reconnect instead of failing, see `publish.Outbox`, and subscriptions are made again, see `MQTTClient`
+    mqtt = MQTTClient(
+        client_id=configuration['mqtt'].get('client_id'),
+        config={'default_retain': True, 'auto_reconnect': True, 'reconnect_retries': -1},
+    )
     try:
         await mqtt.connect(
             furl.furl(configuration['mqtt']['server']).set(
                 username=str(configuration['mqtt'].get('user')),
                 password=str(configuration['mqtt'].get('password')),
             ).url)
-        base_topic = configuration['mqtt']['base_topic']
-        await mqtt.subscribe([(f'{base_topic}/#', amqtt.mqtt.constants.QOS_0)])
         yield mqtt
     finally:
         # for any will messages
@@ -46,27 +84,176 @@ async def get_mqtt(configuration):
         await mqtt.disconnect()
 
 
-async def main():
-    parser = argparse.ArgumentParser(description='A naive mimic of zigbee2mqtt for bluetooth with python')
-    parser.add_argument('-c', '--config', default='config/configuration.yaml', help='configuration.yaml location')
-    with open(parser.parse_args().config) as config:
-        configuration = yaml.safe_load(config)
-        base_topic = configuration['mqtt']['base_topic']
-        homeassistant_discovery_topic = 'homeassistant'
-        async with get_mqtt(configuration) as mqtt, get_devices_reg(configuration) as devices_reg:
-            print(f'<6>initialized with {len(devices_reg)} devices')
-            await asyncio.gather(*(device.bindMQTT(
-                mqtt=mqtt,
+async def report_stats(mqtt: publish.Outbox, topic: str, devices_reg: registry.Registry, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        stats = {'concurrency': [concurrency.report() for concurrency in devices_reg.pool.concurrencies], 'outbox': mqtt.report()}
+        await mqtt.publish(topic, json.dumps(stats).encode('utf8'), retain=False)
+
+
+async def serve(configuration, load_configuration: collections.abc.Callable[[], dict] | None = None, **client_kwargs):
+    """
+    With `load_configuration`, SIGHUP or any message to `{base_topic}/bridge/request/reload` reloads the configuration.
+    Only the devices whose configuration changed are exited and entered again, see `registry.Registry.load`,
+    groups are rebuilt and the mqtt connection is kept.
+    With `cluster`, bridges sharing the broker split the devices between them, see `cluster.Cluster`.
+    With `trace`, the traffic of the bridge is recorded for `replay.py`, see `tracing`.
+    """
+    log.configure(configuration.get('logging'))
+    base_topic = configuration['mqtt']['base_topic']
+    homeassistant_discovery_topic = 'homeassistant'
+    discovery.cache.load(configuration['mqtt'].get('discovery_cache', 'config/discovery_cache.json'), configuration['mqtt']['server'])
+    snapshot.store.load(configuration['controller'].get('snapshot', 'config/state.json'))
+    async with tracing.recording(configuration.get('trace'), base_topic, configuration['devices']), get_mqtt(configuration) as mqtt, \
+            publish.Outbox(mqtt, configuration['mqtt'].get('publish_window', 16)) as outbox, \
+            registry.Registry(**client_kwargs) as devices_reg:
+        await devices_reg.load(configuration)
+        logger.info('initialized with %d devices', len(devices_reg))
+        groups: dict[str, group.Group] = {}
+        queues: dict[str, dispatch.CommandQueue] = {}
+        poller: asyncio.Task | None = None
+        nodes: cluster.Cluster | None = None
+        if 'cluster' in configuration:
+            options = dict(configuration['cluster'] or {})
+            nodes = cluster.Cluster(outbox, f'{base_topic}/bridge/cluster', devices_reg, options.pop('node', socket.gethostname()), **options)
+        # devices bound to mqtt, in a cluster only once owned
+        bound: set[BaseDevice] = set()
+        router = dispatch.Router()
+        # devices and groups whose commands are subscribed to
+        routed: set[str] = set()
+
+        async def route(identifier: str):
+            if identifier in routed:
+                return
+            routed.add(identifier)
+            router.add(f'{base_topic}/{identifier}/#', lambda topic, data: queues[identifier].submit(topic, data))
+            await mqtt.subscribe([(f'{base_topic}/{identifier}/{command}', amqtt.mqtt.constants.QOS_0) for command in COMMAND_TOPICS])
+
+        async def unroute(identifier: str):
+            if identifier not in routed:
+                return
+            routed.remove(identifier)
+            router.remove(f'{base_topic}/{identifier}/#')
+            await mqtt.unsubscribe([f'{base_topic}/{identifier}/{command}' for command in COMMAND_TOPICS])
+
+        def handles(handler: BaseDevice):
+            return not nodes or isinstance(handler, group.Group) or nodes.owns(handler)
+
+        async def bind_device(identifier: str, device: BaseDevice):
+            bound.add(device)
+            if hasattr(device, 'client'):
+                tracing.recorder.record('bind', identifier, device.client.address)
+            await device.bindMQTT(
+                mqtt=outbox,
                 device_topic=f'{base_topic}/{identifier}',
                 homeassistant_discovery_topic=homeassistant_discovery_topic,
-            ) for identifier, device in devices_reg.items()))
+            )
+            await route(identifier)
+
+        async def bind(configuration, devices: list[BaseDevice]):
+            ''' binds `devices` and every group to mqtt, keeping the queues of unchanged devices '''
+            nonlocal groups, poller
+            for old_group in groups.values():
+                await old_group.__aexit__(None, None, None)
+            groups = group.get_groups(configuration, devices_reg.by_identifier(), queues, nodes.owns if nodes else None)
+            handlers: dict[str, BaseDevice] = {**devices_reg.by_identifier(), **groups}
+            for identifier in set(queues) - set(handlers):
+                await unroute(identifier)
+                del queues[identifier]
+            for identifier, handler in handlers.items():
+                queue = queues.get(identifier)
+                if not queue or queue.device is not handler:
+                    queues[identifier] = dispatch.CommandQueue(handler, configuration['mqtt'].get('queue_depth', 8))
+                    while queue and queue.pending:
+                        _, topic, data, done = queue.pending.popleft()
+                        queues[identifier].submit(topic, data, done)
+            await asyncio.gather(*(
+                bind_device(identifier, handler) for identifier, handler in handlers.items()
+                if (handler in devices and handles(handler)) or identifier in groups
+            ))
+            if poller:
+                poller.cancel()
+            poller = asyncio.create_task(
+                polling.Poller(devices_reg.devices.values(), **configuration.get('polling', {}), owns=nodes.owns if nodes else None).run())
+
+        def on_acquire(device: BaseDevice):
+            if device not in bound:
+                asyncio.create_task(bind_device(device.identifier, device))
+            else:
+                asyncio.create_task(route(device.identifier))
+
+        def on_release(device: BaseDevice):
+            asyncio.create_task(unroute(device.identifier))
+            if device.identifier in queues:
+                queues[device.identifier].clear()
+            asyncio.create_task(device.client.disconnect())
+
+        reloading = asyncio.Lock()
+
+        async def reload():
+            async with reloading:
+                try:
+                    reloaded = load_configuration()
+                except Exception as error:
+                    logger.error('main.serve reload failed because: %r', error)
+                    return
+                if reloaded['mqtt'] != configuration['mqtt'] or reloaded.get('trace') != configuration.get('trace'):
+                    logger.warning('main.serve reload ignores mqtt and trace changes until restart')
+                log.configure(reloaded.get('logging'))
+                entered, exited = await devices_reg.load(reloaded)
+                bound.difference_update(exited)
+                await bind(reloaded, entered)
+                logger.info('reloaded, %d devices entered and %d exited', len(entered), len(exited))
+
+        def on_homeassistant_status(_, data: str):
+            if data == 'online':
+                asyncio.create_task(discovery.cache.republish(outbox))
+
+        router.add(f'{homeassistant_discovery_topic}/status', on_homeassistant_status)
+        bridge_topics = [f'{homeassistant_discovery_topic}/status']
+        if load_configuration:
+            router.add(f'{base_topic}/bridge/request/reload', lambda *_: asyncio.create_task(reload()))
+            bridge_topics.append(f'{base_topic}/bridge/request/reload')
+        if nodes:
+            router.add(f'{base_topic}/bridge/cluster/+', lambda topic, data: nodes.observe(topic[0], data))
+            bridge_topics.append(f'{base_topic}/bridge/cluster/+')
+        await mqtt.subscribe([(topic, amqtt.mqtt.constants.QOS_0) for topic in bridge_topics])
+        await bind(configuration, list(devices_reg.devices.values()))
+        asyncio.create_task(snapshot.store.run(devices_reg.devices, configuration['controller'].get('snapshot_interval', 300)))
+        asyncio.create_task(
+            report_stats(outbox, f'{base_topic}/bridge/stats', devices_reg, configuration['controller'].get('report_interval', 60)))
+        if load_configuration and hasattr(signal, 'SIGHUP'):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(reload()))
+        if nodes:
+            nodes.on('acquire', on_acquire)
+            nodes.on('release', on_release)
+            asyncio.create_task(nodes.run())
+        try:
             while True:
                 message = await mqtt.deliver_message()
-                base_topic, identifier, *topic = message.topic.split('/')
-                data = message.data.decode('utf8')
-                if identifier in devices_reg:
-                    asyncio.create_task(devices_reg[identifier].handleMQTT(topic=topic, data=data))
+                if tracing.recorder.file:
+                    tracing.recorder.record('receive', message.topic, message.data.decode('utf8', 'replace'))
+                matched = router.match(message.topic)
+                if matched:
+                    handler, topic = matched
+                    handler(topic, message.data.decode('utf8'))
+        finally:
+            if nodes:
+                await nodes.leave()
+
+
+def read_configuration(path: str) -> dict:
+    with open(path) as config:
+        return yaml.safe_load(config)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='A naive mimic of zigbee2mqtt for bluetooth with python')
+    parser.add_argument('-c', '--config', default='config/configuration.yaml', help='configuration.yaml location')
+    path = parser.parse_args().config
+    await serve(read_configuration(path), lambda: read_configuration(path))
 
 
-signal.signal(signal.SIGTERM, signal.getsignal(signal.SIGINT))
-asyncio.run(main())
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, signal.getsignal(signal.SIGINT))
+    asyncio.run(main())
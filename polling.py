@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import asyncio
+import collections.abc
+import logging
+import time
+
+import bluetooth
+from device.interface import BaseDevice
+
+logger = logging.getLogger(__name__)
+
+
+class Poller:
+    '''
+    Keeps device fields within their staleness budget, see `BaseDevice.get_stale`.
+
+    1. all stale fields of a device are read in one pass, over one connection
+    2. a device that connects for another reason is polled right away, once its fields are `early` stale
+    3. otherwise polls run one at a time, at least `spacing` seconds apart,
+       devices with more stale fields first, and never while commands are waiting for the adapter
+    '''
+
+    def __init__(self,
+                 devices: collections.abc.Iterable[BaseDevice],
+                 early: float = 0.5,
+                 spacing: float = 10,
+                 tick: float = 30,
+                 owns: collections.abc.Callable[[BaseDevice], bool] | None = None):
+        ''' `owns` limits polls to the devices this bridge is responsible for, see `cluster.Cluster` '''
+        self.devices = [device for device in devices if hasattr(device, 'get_stale')]
+        self.owns = owns or (lambda device: True)
+        self.early = early
+        self.spacing = spacing
+        self.tick = tick
+        self.polling: set[BaseDevice] = set()
+        self.last_poll = 0.0
+
+    async def poll(self, device: BaseDevice, fields: list[str]):
+        bluetooth.current_priority.set(bluetooth.Priority.POLL)
+        self.polling.add(device)
+        try:
+            await device.poll(fields)
+        except Exception as error:
+            logger.warning('polling.Poller.poll %s %s failed because: %r', device.identifier, fields, error)
+        finally:
+            self.polling.discard(device)
+
+    def on_connect(self, device: BaseDevice):
+        fields = device.get_stale(self.early)
+        if fields and device not in self.polling and self.owns(device):
+            asyncio.create_task(self.poll(device, fields))
+
+    def is_busy(self, device: BaseDevice):
+        return device in self.polling or device.client.concurrency.report()['waiting'] > 0
+
+    async def run(self):
+        listeners = [
+            (device, device.client.event.on('connect', lambda device=device: self.on_connect(device)))
+            for device in self.devices
+        ]
+        try:
+            while True:
+                due = [device for device in self.devices if self.owns(device) and device.get_stale()]
+                for device in sorted(due, key=lambda device: -len(device.get_stale())):
+                    await asyncio.sleep(max(0, self.last_poll + self.spacing - time.monotonic()))
+                    fields = device.get_stale()
+                    if fields and not self.is_busy(device):
+                        self.last_poll = time.monotonic()
+                        await self.poll(device, fields)
+                await asyncio.sleep(self.tick)
+        finally:
+            # a poller is replaced on reload
+            for device, listener in listeners:
+                device.client.event.remove_listener('connect', listener)
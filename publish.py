@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import collections.abc
+import itertools
+import json
+import logging
+import time
+
+import amqtt.client
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+class StatePublisher:
+    '''
+    Sits between device state and mqtt.
+
+    1. a state identical to the last published one is not published again
+    2. updates within `window` seconds are coalesced into one message
+    3. a field changing more often than its `min_interval` keeps its last published value until the interval passes
+    '''
+
+    def __init__(self, mqtt: Outbox, topic: str, window: float = 0.5, min_interval: dict[str, float] | None = None):
+        self.mqtt = mqtt
+        self.topic = topic
+        self.window = window
+        self.min_interval = min_interval or {}
+        self.state: dict = {}
+        self.published: dict | None = None
+        self.published_at: dict[str, float] = {}
+        self.timer: asyncio.TimerHandle | None = None
+        self.hold_timer: asyncio.TimerHandle | None = None
+
+    async def publish(self, state: dict):
+        ''' publish right away, e.g. the initial state '''
+        self.state = dict(state)
+        for timer in (self.timer, self.hold_timer):
+            if timer:
+                timer.cancel()
+        self.timer = self.hold_timer = None
+        await self.mqtt.publish(self.topic, self.encode(self.state))
+
+    def update(self, state: dict):
+        self.state = dict(state)
+        if not self.timer:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        self.timer = None
+        if self.hold_timer:
+            self.hold_timer.cancel()
+            self.hold_timer = None
+        now = time.monotonic()
+        published = self.published or {}
+        held = {
+            field: self.published_at[field] + self.min_interval[field]
+            for field, value in self.state.items()
+            if field in published and value != published[field] and field in self.min_interval and now < self.published_at[field] + self.min_interval[field]
+        }
+        if held:
+            self.hold_timer = asyncio.get_running_loop().call_later(min(held.values()) - now, self.flush)
+        state = {field: published[field] if field in held else value for field, value in self.state.items()}
+        if state != self.published:
+            self.mqtt.put(self.topic, self.encode(state))
+
+    def encode(self, state: dict):
+        now = time.monotonic()
+        published = self.published or {}
+        for field, value in state.items():
+            if field not in published or published[field] != value:
+                self.published_at[field] = now
+        self.published = state
+        return json.dumps(state).encode('utf8')
+
+
+class Outbox:
+    '''
+    The one queue every publish to mqtt goes through, with the `publish` of an `amqtt.client.MQTTClient`.
+
+    1. no more than `window` publishes are in flight at a time, the others wait in order
+    2. a topic keeps only its latest pending message, so a broker outage holds at most one message per topic
+    3. while the broker is unreachable, publishes wait for the client to reconnect and the queue flushes through the same window
+    4. a failed publish is sent again after `retry` seconds, unless a newer message for its topic was queued meanwhile
+    5. `done` of a message is called once the broker took it, never for a message superseded or dropped
+    '''
+
+    def __init__(self, mqtt: amqtt.client.MQTTClient, window: int = 16, retry: float = 5):
+        self.mqtt = mqtt
+        self.window = window
+        self.retry = retry
+        # topic -> (message, retain, sequence, done), in order of first queueing
+        self.pending: collections.OrderedDict[str, tuple[bytes, bool, int, collections.abc.Callable[[], None] | None]] = collections.OrderedDict()
+        # topic -> sequence of its latest message
+        self.sequences: dict[str, int] = {}
+        self.counter = itertools.count()
+        self.inflight = 0
+        self.stats: collections.Counter[str] = collections.Counter()
+        self.queued = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.workers: list[asyncio.Task] = []
+
+    async def __aenter__(self) -> 'Outbox':
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.window)]
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        ''' gives the last messages, e.g. availability, `retry` seconds to go out '''
+        try:
+            await asyncio.wait_for(self.drained.wait(), self.retry)
+        except asyncio.TimeoutError:
+            logger.warning('publish.Outbox.__aexit__ dropped %d messages', len(self.pending))
+        for worker in self.workers:
+            worker.cancel()
+
+    def put(self, topic: str, message: bytes, retain: bool = True, done: collections.abc.Callable[[], None] | None = None):
+        if topic in self.pending:
+            self.stats['superseded'] += 1
+        self.sequences[topic] = sequence = next(self.counter)
+        self.pending[topic] = (message, retain, sequence, done)
+        self.queued.set()
+        self.drained.clear()
+
+    async def publish(self, topic: str, message: bytes, retain: bool = True, done: collections.abc.Callable[[], None] | None = None):
+        ''' queues, it does not wait for the broker, see `done` to know when it took the message '''
+        self.put(topic, message, retain, done)
+
+    def report(self):
+        return {'pending': len(self.pending), 'inflight': self.inflight, **self.stats}
+
+    async def work(self):
+        while True:
+            while not self.pending:
+                self.queued.clear()
+                await self.queued.wait()
+            topic, (message, retain, sequence, done) = self.pending.popitem(last=False)
+            self.inflight += 1
+            try:
+                await self.mqtt.publish(topic, message, retain=retain)
+            except Exception as error:
+                self.stats['failures'] += 1
+                logger.warning('publish.Outbox.work %s retry because: %r', topic, error)
+                if self.sequences[topic] == sequence and topic not in self.pending:
+                    self.pending[topic] = (message, retain, sequence, done)
+                    self.pending.move_to_end(topic, last=False)
+                await asyncio.sleep(self.retry)
+            else:
+                self.stats['published'] += 1
+                if tracing.recorder.file:
+                    tracing.recorder.record('publish', topic, message.decode('utf8', 'replace'))
+                # the broker took the message whatever `done` does, it is neither retried nor counted as failed
+                if done:
+                    try:
+                        done()
+                    except Exception as error:
+                        logger.error('publish.Outbox.work %s done failed because: %r', topic, error)
+            finally:
+                self.inflight -= 1
+                if not self.pending and not self.inflight:
+                    self.drained.set()
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import importlib
+import logging
+
+import bluetooth
+import snapshot
+from device.interface import BaseDevice, LazyDevice
+
+logger = logging.getLogger(__name__)
+
+
+def get_adapter_pool(configuration) -> bluetooth.AdapterPool:
+    """
+    `controller.adapters` lists adapters as `{address, capacity}`.
+    Without it, `controller.address` and `controller.capacity` describe a single adapter.
+    """
+    adapters = configuration['controller'].get('adapters') or [configuration['controller']]
+    return bluetooth.AdapterPool([
+        bluetooth.Concurrency(adapter.get('capacity', 6), adapter=adapter.get('address')) for adapter in adapters
+    ])
+
+
+def create_device(address, device_config, pool: bluetooth.AdapterPool, **client_kwargs) -> BaseDevice:
+    ''' `client_kwargs` are passed to `bluetooth.Client`, e.g. `retry` and `breaker` '''
+    device_config = dict(device_config)
+    device_type = device_config.pop('type')
+    adapter = device_config.pop('adapter', None)
+    concurrency = pool.place(address, adapter)
+    # a device pinned to an adapter stays there
+    client = bluetooth.Client(address, concurrency, pool if len(pool.concurrencies) > 1 and adapter is None else None, **client_kwargs)
+    return importlib.import_module(f'device.{device_type}').Device(client, **device_config)
+
+
+class Registry:
+    """
+    The devices of a configuration, by MAC address, each entered in an `AsyncExitStack` of its own.
+
+    1. `load` diffs a configuration against the loaded one and only exits and enters the devices that changed,
+       the others stay connected
+    2. a change of `controller` rebuilds the adapters, so every device is entered again
+    3. devices are entered in parallel, but no more than the total adapter capacity at a time
+
+    A device that cannot initialize within `startup_timeout` falls back to lazy activation.
+    A device restored from `snapshot.store` is registered right away and entered in the background at `Priority.POLL`.
+    With `lazy` set, the default with `cluster`, devices are only registered here and connect on their first command.
+    With several adapters, devices without a static `adapter` are placed by the best RSSI of a startup scan.
+    Unless `scanner` is off, every adapter runs a shared scanner that clients connect from.
+    `client_kwargs` are passed to every `bluetooth.Client`, e.g. `backend` to run against simulated devices.
+    """
+
+    def __init__(self, **client_kwargs):
+        self.client_kwargs = client_kwargs
+        self.configuration: dict = {'controller': None, 'devices': {}}
+        self.pool: bluetooth.AdapterPool | None = None
+        self.devices: dict[str, BaseDevice] = {}
+        self.stacks: dict[str, contextlib.AsyncExitStack] = {}
+        self.placed: dict[str, bluetooth.Concurrency] = {}
+        self.scanners = contextlib.AsyncExitStack()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def by_identifier(self) -> dict[str, BaseDevice]:
+        return {device.identifier: device for device in self.devices.values()}
+
+    async def __aenter__(self) -> 'Registry':
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            snapshot.store.save(self.devices)
+        finally:
+            try:
+                await self.exit(list(self.devices))
+            finally:
+                await self.scanners.aclose()
+
+    async def load(self, configuration) -> tuple[list[BaseDevice], list[BaseDevice]]:
+        ''' returns the devices entered and exited '''
+        devices = configuration['devices'] or {}
+        if configuration['controller'] != self.configuration['controller']:
+            changed = list(self.devices)
+        else:
+            changed = [address for address in self.devices if devices.get(address) != self.configuration['devices'].get(address)]
+        exited = [self.devices[address] for address in changed]
+        await self.exit(changed)
+        if configuration['controller'] != self.configuration['controller']:
+            await self.scanners.aclose()
+            self.pool = get_adapter_pool(configuration)
+            if configuration['controller'].get('scanner', True):
+                self.scanners.push_async_callback(self.pool.stop_scanners)
+                await self.pool.start_scanners(configuration['controller'].get('absent_after', 120))
+            if len(self.pool.concurrencies) > 1:
+                await self.pool.scan(configuration['controller'].get('scan_timeout', 5))
+        self.configuration = {'controller': configuration['controller'], 'devices': devices}
+        # in a cluster, only the owner of a device should connect to it
+        self.lazy = configuration['controller'].get('lazy', 'cluster' in configuration)
+        semaphore = asyncio.Semaphore(sum(concurrency.capacity for concurrency in self.pool.concurrencies))
+        entered = await asyncio.gather(*(self.enter(address, semaphore) for address in devices if address not in self.devices))
+        return [device for device in entered if device], exited
+
+    async def enter(self, address: str, semaphore: asyncio.Semaphore) -> BaseDevice | None:
+        controller = self.configuration['controller']
+        device_config = dict(self.configuration['devices'][address])
+        device_lazy = device_config.pop('lazy', self.lazy)
+        try:
+            device = create_device(
+                address, device_config, self.pool,
+                retry=bluetooth.RetryPolicy(**controller.get('retry', {})),
+                breaker=bluetooth.CircuitBreaker(**controller.get('breaker', {})),
+                **self.client_kwargs,
+            )
+        except Exception as error:
+            logger.error('registry.Registry.enter %s skipped because: %r', address, error)
+            return None
+        self.placed[address] = device.client.concurrency
+        restored = snapshot.store.restore(address, device)
+        stack = contextlib.AsyncExitStack()
+        if not device_lazy and not restored:
+            async with semaphore:
+                try:
+                    await asyncio.wait_for(device.__aenter__(), controller.get('startup_timeout', 60))
+                    stack.push_async_exit(device)
+                except Exception as error:
+                    logger.warning('registry.Registry.enter %s deferred because: %r', address, error)
+                    with contextlib.suppress(Exception):
+                        await device.__aexit__(None, None, None)
+                    device_lazy = True
+        if device_lazy or restored:
+            device = await stack.enter_async_context(LazyDevice(device))
+            # exiting a device that failed stopped probing its open circuit, it waits for its first command
+            device.client.start_probing()
+            stack.callback(device.client.stop_probing)
+        if restored and not device_lazy:
+            stack.callback(asyncio.create_task(self.warm_up(device, semaphore)).cancel)
+        self.devices[address] = device
+        self.stacks[address] = stack
+        return device
+
+    async def warm_up(self, device: LazyDevice, semaphore: asyncio.Semaphore):
+        bluetooth.current_priority.set(bluetooth.Priority.POLL)
+        async with semaphore:
+            try:
+                await asyncio.wait_for(device.activate(), self.configuration['controller'].get('startup_timeout', 60))
+            except Exception as error:
+                logger.warning('registry.Registry.warm_up %s deferred because: %r', device.client.address, error)
+                with contextlib.suppress(Exception):
+                    await device.device.__aexit__(None, None, None)
+                device.client.start_probing()
+
+    async def exit(self, addresses: list[str]):
+        for address in addresses:
+            self.devices.pop(address)
+            self.pool.assigned[self.placed.pop(address)] -= 1
+        await asyncio.gather(*(self.stacks.pop(address).aclose() for address in addresses), return_exceptions=True)
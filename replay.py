@@ -0,0 +1,164 @@
+'''
+Replays a trace recorded by `tracing` through the whole bridge, against simulated devices from `simulation.py`.
+
+    python3 replay.py config/trace.jsonl.gz --speed 1 --out replayed.jsonl.gz
+    python3 replay.py config/trace.jsonl.gz --fast
+
+The mqtt commands of the trace are sent at their recorded times, `--speed` times faster, or back to back with `--fast`.
+Disconnects the devices initiated are replayed as links lost by the simulated devices.
+Connect failures are not replayed one by one, the simulated radio fails at the rates given instead.
+Prints a summary of the recorded and the replayed traffic as JSON, see `tracing.summarize`.
+'''
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+import amqtt.broker
+import amqtt.client
+import amqtt.mqtt.constants
+
+import main
+import simulation
+import tracing
+
+logger = logging.getLogger('replay')
+
+LOCAL_KEY = 'replay'
+
+
+def create_devices(args, header: dict, sim: simulation.Simulation):
+    ''' a simulated device for every device of the trace, fingerbots get a key of their own '''
+    devices = {}
+    for address, device_type in header['devices'].items():
+        if device_type == 'am43':
+            sim.add(simulation.VirtualAM43(address, speed=args.speed_am43, latency=args.latency))
+            devices[address] = {'type': 'am43'}
+        elif device_type == 'tuya.fingerbot':
+            sim.add(simulation.VirtualFingerBot(address, local_key=LOCAL_KEY, idle_timeout=args.idle_timeout, latency=args.latency))
+            devices[address] = {'type': 'tuya.fingerbot', 'device_id': 'replay', 'uuid': 'tuyareplay', 'local_key': LOCAL_KEY}
+        else:
+            logger.warning('replay.create_devices %s skipped because %s cannot be simulated', address, device_type)
+    return devices
+
+
+def get_workload(header: dict, events: list[list]):
+    ''' the commands sent to the bridge and the disconnects of its devices, as `(at, kind, *fields)` from the first command '''
+    base_topic = header['base_topic']
+    workload = [
+        event for event in events
+        if (event[1] == 'receive' and event[2].startswith(f'{base_topic}/') and not event[2].startswith(f'{base_topic}/bridge/'))
+        or (event[1] == 'disconnect' and not event[3])
+    ]
+    start = next((event[0] for event in workload if event[1] == 'receive'), 0)
+    return [(at - start, kind, *fields) for at, kind, *fields in workload if at >= start]
+
+
+async def replay(args):
+    header, events = tracing.read(args.trace)
+    sim = simulation.Simulation(
+        connect_delay=args.connect_delay,
+        disconnect_delay=args.disconnect_delay,
+        abort_rate=args.abort_rate,
+        not_found_rate=args.not_found_rate,
+        write_error_rate=args.write_error_rate,
+        mtu=args.mtu,
+        seed=args.seed,
+    )
+    devices = create_devices(args, header, sim)
+    base_topic = header['base_topic']
+    server = args.server or f'mqtt://127.0.0.1:{args.port}'
+    configuration = {
+        'mqtt': {'base_topic': base_topic, 'server': server, 'client_id': 'ble2mqtt_replay_bridge', 'discovery_cache': None},
+        'controller': {'capacity': args.capacity, 'report_interval': 3600, 'scanner': False, 'snapshot': None},
+        'devices': devices,
+        'trace': {'path': args.out} if args.out else None,
+    }
+    broker = None
+    if not args.server:
+        broker = amqtt.broker.Broker({
+            'listeners': {'default': {'type': 'tcp', 'bind': f'127.0.0.1:{args.port}'}},
+            'plugins': {'amqtt.plugins.authentication.AnonymousAuthPlugin': {'allow_anonymous': True}},
+        })
+        await broker.start()
+
+    driver = amqtt.client.MQTTClient(client_id='ble2mqtt_replay_driver')
+    await driver.connect(server)
+    await driver.subscribe([(f'{base_topic}/+/availability', amqtt.mqtt.constants.QOS_0)])
+    online: set[str] = set()
+    ready = asyncio.Event()
+
+    async def receive():
+        while True:
+            message = await driver.deliver_message()
+            if message.data == b'online':
+                online.add(message.topic)
+                if len(online) == len(devices):
+                    ready.set()
+
+    receiver = asyncio.create_task(receive())
+    bridge = asyncio.create_task(main.serve(configuration, backend=sim.backend))
+    try:
+        await asyncio.wait_for(ready.wait(), args.startup_timeout)
+    except asyncio.TimeoutError:
+        logger.warning('replay.replay starts with %d of %d devices online', len(online), len(devices))
+
+    started = time.monotonic()
+    workload = get_workload(header, events)
+    for at, kind, *fields in workload:
+        if not args.fast:
+            await asyncio.sleep(max(0, started + at / args.speed - time.monotonic()))
+        if kind == 'receive':
+            topic, data = fields
+            await driver.publish(topic, data.encode('utf8'), retain=False)
+        else:
+            peripheral = sim.peripherals.get(fields[0].upper())
+            if peripheral and peripheral.backend:
+                peripheral.backend.drop()
+    await asyncio.sleep(args.settle)
+    elapsed = time.monotonic() - started
+
+    bridge.cancel()
+    receiver.cancel()
+    await asyncio.gather(bridge, receiver, return_exceptions=True)
+    await driver.disconnect()
+    if broker:
+        await broker.shutdown()
+    report = {
+        'commands': sum(1 for _, kind, *_ in workload if kind == 'receive'),
+        'elapsed': elapsed,
+        'recorded': tracing.summarize(header, events),
+        'radio': dict(sim.stats),
+    }
+    if args.out:
+        report['replayed'] = tracing.summarize(*tracing.read(args.out))
+    return report
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Replay a ble2mqtt trace against simulated devices')
+    parser.add_argument('trace', help='trace recorded with the trace section of the configuration')
+    parser.add_argument('--out', default=None, help='record the replay to this trace, to summarize it next to the recorded one')
+    parser.add_argument('--speed', type=float, default=1, help='replay this many times faster than recorded')
+    parser.add_argument('--fast', action='store_true', help='send the commands back to back, as fast as possible')
+    parser.add_argument('--settle', type=float, default=5, help='seconds to wait after the last command')
+    parser.add_argument('--capacity', type=int, default=6, help='controller capacity')
+    parser.add_argument('--connect-delay', type=float, default=1, help='seconds per simulated connect')
+    parser.add_argument('--disconnect-delay', type=float, default=1, help='seconds per simulated disconnect')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds before a simulated device replies')
+    parser.add_argument('--speed-am43', type=float, default=50, help='AM43 motor speed in percent per second')
+    parser.add_argument('--idle-timeout', type=float, default=None, help='seconds before a fingerbot drops an idle connection')
+    parser.add_argument('--abort-rate', type=float, default=0, help='probability of le-connection-abort-by-local per connect')
+    parser.add_argument('--not-found-rate', type=float, default=0, help='probability of device not found per connect')
+    parser.add_argument('--write-error-rate', type=float, default=0, help='probability of a failed gatt write')
+    parser.add_argument('--mtu', type=int, default=23, help='ATT MTU of simulated connections')
+    parser.add_argument('--startup-timeout', type=float, default=600, help='seconds to wait for every device to come online')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--port', type=int, default=18831, help='port of the embedded MQTT broker')
+    parser.add_argument('--server', default=None, help='use this MQTT server instead of the embedded broker')
+    return parser
+
+
+if __name__ == '__main__':
+    print(json.dumps(asyncio.run(replay(get_parser().parse_args())), indent=2))
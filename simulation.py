@@ -0,0 +1,341 @@
+'''
+A simulated bluetooth backend with virtual peripherals, to run the bridge without any hardware.
+
+Pass `Simulation.backend` as the `backend` of `bluetooth.Client`, e.g. `main.serve(configuration, backend=simulation.backend)`.
+Peripherals speak the same protocols as the real devices in `device/am43.py` and `device/tuya`.
+'''
+from __future__ import annotations
+
+import asyncio
+import collections
+import collections.abc
+import functools
+import math
+import random
+import secrets
+import time
+from struct import pack, unpack
+
+import bleak
+import bleak.exc
+from Crypto.Cipher import AES
+
+import bluetooth
+import crypto
+from device.am43 import AM43
+from device.tuya import util
+from device.tuya.fingerbot import TuyaFingerBot
+
+
+class Characteristic:
+
+    def __init__(self, uuid: str, handle: int):
+        self.uuid = uuid
+        self.handle = handle
+
+    def __str__(self):
+        return f'{self.uuid} (Handle: {self.handle})'
+
+
+class Services:
+    ''' the part of bleak.backends.service.BleakGATTServiceCollection used by bleak.BleakClient '''
+
+    def __init__(self, uuids: collections.abc.Iterable[str]):
+        self.characteristics = {handle: Characteristic(uuid, handle) for handle, uuid in enumerate(uuids)}
+
+    def get_characteristic(self, specifier) -> Characteristic | None:
+        if isinstance(specifier, Characteristic):
+            return specifier
+        if isinstance(specifier, int):
+            return self.characteristics.get(specifier)
+        return next((characteristic for characteristic in self.characteristics.values() if characteristic.uuid == str(specifier).lower()), None)
+
+
+class Simulation:
+    '''
+    The radio shared by all virtual peripherals.
+    Delays are in seconds, error rates are probabilities per connect/write.
+    `capacity` is the hardware connection limit of each adapter, `mtu` the ATT MTU every connection negotiates.
+    '''
+
+    def __init__(self,
+                 connect_delay: float = 1,
+                 disconnect_delay: float = 1,
+                 write_delay: float = 0.02,
+                 capacity: int = 7,
+                 abort_rate: float = 0,
+                 not_found_rate: float = 0,
+                 write_error_rate: float = 0,
+                 mtu: int = 23,
+                 seed: int | None = None):
+        self.connect_delay = connect_delay
+        self.disconnect_delay = disconnect_delay
+        self.write_delay = write_delay
+        self.capacity = capacity
+        self.abort_rate = abort_rate
+        self.not_found_rate = not_found_rate
+        self.write_error_rate = write_error_rate
+        self.mtu = mtu
+        self.random = random.Random(seed)
+        self.peripherals: dict[str, Peripheral] = {}
+        self.connected: collections.Counter[str | None] = collections.Counter()
+        self.stats: collections.Counter[str] = collections.Counter()
+
+    def add(self, peripheral: Peripheral):
+        self.peripherals[peripheral.address.upper()] = peripheral
+        return peripheral
+
+    @property
+    def backend(self):
+        return functools.partial(Backend, simulation=self)
+
+
+class Backend:
+    ''' implements the part of bleak.backends.client.BaseBleakClient used by bleak.BleakClient '''
+
+    def __init__(self, address_or_ble_device, disconnected_callback=None, *, simulation: Simulation, adapter: str | None = None, **kwargs):
+        self.address: str = getattr(address_or_ble_device, 'address', address_or_ble_device)
+        self.disconnected_callback = disconnected_callback
+        self.simulation = simulation
+        self.adapter = adapter
+        self.peripheral = simulation.peripherals.get(self.address.upper())
+        self.is_connected = False
+        self.services: Services | None = None
+        self.mtu_size = simulation.mtu
+        self.callbacks: dict[str, collections.abc.Callable[[bytearray], None]] = {}
+
+    async def connect(self, **kwargs):
+        simulation = self.simulation
+        simulation.stats['connect_attempts'] += 1
+        await asyncio.sleep(simulation.connect_delay)
+        if not self.peripheral or simulation.random.random() < simulation.not_found_rate:
+            raise bleak.exc.BleakDeviceNotFoundError(self.address, f'Device with address {self.address} was not found.')
+        if simulation.connected[self.adapter] >= simulation.capacity or simulation.random.random() < simulation.abort_rate:
+            simulation.stats['connect_aborts'] += 1
+            raise bleak.exc.BleakDBusError('org.bluez.Error.Failed', ['le-connection-abort-by-local'])
+        if self.peripheral.backend not in (None, self):
+            raise bleak.exc.BleakDBusError('org.bluez.Error.InProgress', ['Operation already in progress'])
+        simulation.connected[self.adapter] += 1
+        simulation.stats['connects'] += 1
+        self.is_connected = True
+        self.services = Services(self.peripheral.CHARACTERISTICS)
+        self.peripheral.attach(self)
+        return True
+
+    async def disconnect(self):
+        if self.is_connected:
+            await asyncio.sleep(self.simulation.disconnect_delay)
+            self.drop()
+        return True
+
+    def drop(self):
+        ''' the link is lost, from either side '''
+        if not self.is_connected:
+            return
+        self.is_connected = False
+        self.callbacks.clear()
+        self.simulation.connected[self.adapter] -= 1
+        self.simulation.stats['disconnects'] += 1
+        self.peripheral.detach()
+        if self.disconnected_callback:
+            self.disconnected_callback()
+
+    async def write_gatt_char(self, char_specifier, data: collections.abc.Iterable[int], response: bool = False):
+        if not self.is_connected:
+            raise bleak.exc.BleakError('Not connected')
+        characteristic = self.services.get_characteristic(char_specifier)
+        if not characteristic:
+            raise bleak.exc.BleakError(f'Characteristic {char_specifier} was not found!')
+        if len(bytes(data)) > self.mtu_size - 3:
+            raise bleak.exc.BleakDBusError('org.bluez.Error.Failed', ['Operation failed with ATT error: 0x0d'])
+        await asyncio.sleep(self.simulation.write_delay)
+        if self.simulation.random.random() < self.simulation.write_error_rate:
+            self.simulation.stats['write_errors'] += 1
+            raise bleak.exc.BleakDBusError('org.bluez.Error.Failed', ['Operation failed with ATT error: 0x0e'])
+        self.simulation.stats['writes'] += 1
+        self.peripheral.write(characteristic.uuid, bytes(data))
+
+    async def start_notify(self, characteristic: Characteristic, callback: collections.abc.Callable[[bytearray], None], **kwargs):
+        self.callbacks[characteristic.uuid] = callback
+
+    async def stop_notify(self, char_specifier):
+        characteristic = self.services.get_characteristic(char_specifier) if self.services else None
+        if characteristic:
+            self.callbacks.pop(characteristic.uuid, None)
+
+    def notify(self, uuid: str, data: bytearray):
+        callback = self.callbacks.get(uuid)
+        if self.is_connected and callback:
+            self.simulation.stats['notifications'] += 1
+            callback(data)
+
+
+class Peripheral(bluetooth.EventEmitter):
+    '''
+    A virtual device.
+    `write` receives gatt writes, `notify` sends notifications back after `latency` seconds.
+    Emits `command` for every request it understands.
+    '''
+    CHARACTERISTICS: tuple[str, ...] = ()
+
+    def __init__(self, address: str, latency: float = 0.05):
+        super().__init__()
+        self.address = address
+        self.latency = latency
+        self.backend: Backend | None = None
+
+    def attach(self, backend: Backend):
+        self.backend = backend
+
+    def detach(self):
+        self.backend = None
+
+    def write(self, uuid: str, data: bytes):
+        raise NotImplementedError()
+
+    def notify(self, uuid: str, *payloads: bytes):
+        backend = self.backend
+        if backend:
+            asyncio.get_running_loop().call_later(self.latency, lambda: [backend.notify(uuid, bytearray(payload)) for payload in payloads])
+
+
+class VirtualAM43(Peripheral):
+    ''' `speed` is in percent per second, `notify_interval` pushes position while moving if set '''
+    CHARACTERISTICS = (AM43.CHAR_ID['state'], )
+
+    def __init__(self,
+                 address: str,
+                 position: int = 0,
+                 battery: int = 100,
+                 illuminance: float = 0,
+                 speed: float = 5,
+                 notify_interval: float | None = None,
+                 latency: float = 0.05):
+        super().__init__(address, latency)
+        self.battery = battery
+        self.illuminance = illuminance
+        self.speed = speed
+        self.notify_interval = notify_interval
+        self.origin = self.target = position
+        self.started = time.monotonic()
+        self.motion: asyncio.Task | None = None
+
+    @property
+    def position(self):
+        distance = self.target - self.origin
+        travelled = self.speed * (time.monotonic() - self.started)
+        return self.target if travelled >= abs(distance) else self.origin + math.copysign(travelled, distance)
+
+    def move(self, target: int):
+        self.origin, self.target, self.started = self.position, target, time.monotonic()
+        if self.motion:
+            self.motion.cancel()
+        if self.notify_interval:
+            self.motion = asyncio.create_task(self.report_motion())
+
+    async def report_motion(self):
+        while True:
+            await asyncio.sleep(self.notify_interval)
+            self.reply(AM43.STATE_ID['position'], 0, 0, round(self.position))
+            if self.position == self.target:
+                return
+
+    def write(self, uuid: str, data: bytes):
+        if len(data) < 4 or data[0] != AM43.MESSAGE_MAGIC or crypto.calc_xor_checksum(data[:-1]) != data[-1]:
+            return
+        key, values = data[1], data[3:3 + data[2]]
+        self.emit('command', key, values)
+        if key == AM43.STATE_ID['move']:
+            self.move(values[0])
+            self.reply(key, 0x5a)
+        elif key == AM43.STATE_ID['stop']:
+            self.move(round(self.position))
+            self.reply(key, 0x5a)
+        elif key == AM43.STATE_ID['battery']:
+            self.reply(key, 0, 0, 0, 0, self.battery)
+        elif key == AM43.STATE_ID['position']:
+            self.reply(key, 0, 0, round(self.position))
+        elif key == AM43.STATE_ID['illuminance']:
+            self.reply(key, 0, round(self.illuminance / 12.5))
+
+    def reply(self, key: int, *values: int):
+        data = (AM43.MESSAGE_MAGIC, key, len(values), *values)
+        self.notify(AM43.CHAR_ID['state'], bytes((*data, crypto.calc_xor_checksum(data))))
+
+
+class VirtualFingerBot(Peripheral):
+    ''' `idle_timeout` drops the connection after that many seconds without writes, like the real device does '''
+    CHARACTERISTICS = (TuyaFingerBot.CHAR_ID['notification'], TuyaFingerBot.CHAR_ID['state'])
+
+    def __init__(self, address: str, local_key: str, idle_timeout: float | None = None, latency: float = 0.05):
+        super().__init__(address, latency)
+        self.local_key = local_key
+        self.idle_timeout = idle_timeout
+        self.idle: asyncio.TimerHandle | None = None
+        self.session = util.TuyaSession(local_key)
+        self.buffer = bytearray()
+        self.message_length: int | None = None
+        self.presses = 0
+
+    def attach(self, backend: Backend):
+        super().attach(backend)
+        self.session = util.TuyaSession(self.local_key)
+        self.message_length = None
+        self.touch()
+
+    def detach(self):
+        if self.idle:
+            self.idle.cancel()
+        super().detach()
+
+    def touch(self):
+        if self.idle:
+            self.idle.cancel()
+        if self.idle_timeout and self.backend:
+            self.idle = asyncio.get_running_loop().call_later(self.idle_timeout, self.backend.drop)
+
+    def write(self, uuid: str, data: bytes):
+        if uuid != TuyaFingerBot.CHAR_ID['state']:
+            return
+        self.touch()
+        packet_number, offset = util.read_varint(data, 0)
+        if packet_number == 0:
+            self.message_length, length = util.read_varint(data, offset)
+            offset += length + 1
+            self.buffer = bytearray()
+        self.buffer += data[offset:]
+        if self.message_length is not None and len(self.buffer) >= self.message_length:
+            self.receive(bytes(self.buffer[:self.message_length]))
+            self.message_length = None
+
+    def receive(self, message: bytes):
+        security_flag = message[0]
+        if security_flag not in self.session.keys:
+            return
+        cleartext = AES.new(self.session[security_flag], AES.MODE_CBC, message[1:17]).decrypt(message[17:])
+        sn, ack_sn, code, length = unpack('>IIHH', cleartext[:12])
+        data = cleartext[12:12 + length]
+        self.emit('command', code, data)
+        if code == util.TuyaCode.FUN_SENDER_DEVICE_INFO:
+            srand = secrets.token_bytes(6)
+            self.reply(code, pack('>BBBBBB6sBB32s', 1, 0, 3, 4, 0, 1, srand, 1, 0, bytes(32)), security_flag=4, ack_sn=sn)
+            self.session.set_srand(srand)
+        elif code == util.TuyaCode.FUN_SENDER_DPS:
+            if any(dp_id == TuyaFingerBot.ACTION['CLICK'] and value for dp_id, value in self.parse_dps(data)):
+                self.presses += 1
+                self.emit('press')
+            self.reply(code, b'\x00', ack_sn=sn)
+        elif code in (util.TuyaCode.FUN_SENDER_PAIR, util.TuyaCode.FUN_SENDER_DEVICE_STATUS):
+            self.reply(code, b'\x00', ack_sn=sn)
+
+    def parse_dps(self, data: bytes):
+        offset = 0
+        while offset + 3 <= len(data):
+            dp_id, _, length = data[offset:offset + 3]
+            yield dp_id, int.from_bytes(data[offset + 3:offset + 3 + length], 'big')
+            offset += 3 + length
+
+    def reply(self, code: int, data: bytes, security_flag: int = 5, ack_sn: int = 0):
+        message = util.create_message(self.session, code, data, security_flag=security_flag, ack_sn=ack_sn)
+        packet_size = self.backend.mtu_size - 3 if self.backend else util.DEFAULT_PACKET_SIZE
+        self.notify(TuyaFingerBot.CHAR_ID['notification'], *util.split_packets(message, packet_size))
@@ -0,0 +1,66 @@
+'''
+Device state across restarts.
+
+`store` keeps what every device `dump`s in a compact json file,
+so that on startup a device `restore`s it and is published right away instead of after its first query.
+'''
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+
+from device.interface import BaseDevice
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot:
+
+    def __init__(self):
+        self.path: str | None = None
+        # address -> dump
+        self.devices: dict[str, dict] = {}
+
+    def load(self, path: str | None):
+        self.path = path
+        try:
+            with open(path) as file:
+                self.devices = json.load(file)
+        except (TypeError, OSError, ValueError):
+            self.devices = {}
+
+    def save(self, devices: dict[str, BaseDevice]):
+        ''' a file that cannot be written only costs the warm start, it is logged and tried again on the next save '''
+        if not self.path:
+            return
+        self.devices = {address: device.dump() for address, device in devices.items() if hasattr(device, 'dump')}
+        try:
+            with open(f'{self.path}.tmp', 'w') as file:
+                json.dump(self.devices, file, separators=(',', ':'))
+            os.replace(f'{self.path}.tmp', self.path)
+        except OSError as error:
+            logger.warning('snapshot.Snapshot.save %s failed because: %r', self.path, error)
+            with contextlib.suppress(OSError):
+                os.remove(f'{self.path}.tmp')
+
+    def restore(self, address: str, device: BaseDevice) -> bool:
+        ''' whether `device` got a state to start from '''
+        if not hasattr(device, 'restore') or address not in self.devices:
+            return False
+        try:
+            return device.restore(self.devices[address])
+        except Exception as error:
+            logger.warning('snapshot.Snapshot.restore %s ignored because: %r', address, error)
+            return False
+
+    async def run(self, devices: dict[str, BaseDevice], interval: float):
+        ''' save every `interval` seconds, so that a crash loses no more than that '''
+        while True:
+            await asyncio.sleep(interval)
+            self.save(devices)
+
+
+store = Snapshot()
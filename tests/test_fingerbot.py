@@ -0,0 +1,50 @@
+import asyncio
+
+import bluetooth
+from device.tuya import fingerbot, util
+
+ADDRESS = '00:00:00:00:00:02'
+LOCAL_KEY = 'abcdef0123456789'
+
+
+class Client:
+    ''' just the notifications of a `bluetooth.Client` '''
+
+    def __init__(self):
+        self.address = ADDRESS
+        self.event = bluetooth.EventEmitter()
+        self.notifications: asyncio.Queue[bytes] = asyncio.Queue()
+
+    async def recv_stream_opportunistic(self, char_specifier, **kwargs):
+        while True:
+            yield None, await self.notifications.get()
+
+
+def notify(client: Client, message: bytes):
+    for packet in util.split_packets(message):
+        client.notifications.put_nowait(packet)
+
+
+def test_listener_skips_a_bad_frame():
+    async def run():
+        client = Client()
+        bot = fingerbot.TuyaFingerBot(client, device_id='device', uuid='uuid', local_key=LOCAL_KEY)
+        bot.listener = asyncio.create_task(bot.listen_notification())
+        try:
+            # not a whole number of AES blocks
+            notify(client, b'\x04' + bytes(16) + bytes(20))
+            # the device session key is not known before the handshake
+            notify(client, b'\x05' + bytes(32))
+            good = util.create_message(util.TuyaSession(LOCAL_KEY), util.TuyaCode.FUN_SENDER_DEVICE_STATUS, b'', security_flag=4, ack_sn=7)
+
+            async def send():
+                notify(client, good)
+
+            response = await bot.responses.request(7, send, timeout=2)
+            assert response['ack_sn'] == 7
+            assert response['code'] == util.TuyaCode.FUN_SENDER_DEVICE_STATUS
+            assert not bot.listener.done()
+        finally:
+            bot.listener.cancel()
+
+    asyncio.run(run())
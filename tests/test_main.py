@@ -0,0 +1,107 @@
+import asyncio
+import socket
+import sys
+
+import amqtt.client
+import amqtt.mqtt.constants
+
+import dispatch
+import main
+import simulation
+
+ADDRESS = '00:00:00:00:00:01'
+
+
+def get_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+
+# a broker of its own process, so that a restart drops the connections like a real one
+BROKER = '''
+import asyncio, sys
+import amqtt.broker
+
+async def serve():
+    await amqtt.broker.Broker({
+        'listeners': {'default': {'type': 'tcp', 'bind': f'127.0.0.1:{sys.argv[1]}'}},
+        'plugins': {'amqtt.plugins.authentication.AnonymousAuthPlugin': {'allow_anonymous': True}},
+    }).start()
+    await asyncio.Event().wait()
+
+asyncio.run(serve())
+'''
+
+
+async def start_broker(port: int):
+    broker = await asyncio.create_subprocess_exec(sys.executable, '-c', BROKER, str(port))
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return broker
+        except OSError:
+            await asyncio.sleep(0.1)
+    broker.kill()
+    raise TimeoutError(f'no broker on port {port}')
+
+
+async def stop_broker(broker: asyncio.subprocess.Process):
+    broker.kill()
+    await broker.wait()
+
+
+async def send_until_submitted(server: str, topic: str, data: bytes, submitted: list, timeout: float = 30):
+    ''' sends the command again until a queue got it, the bridge may still be subscribing '''
+    driver = amqtt.client.MQTTClient(client_id='ble2mqtt_test_driver')
+    await driver.connect(server)
+    try:
+        for _ in range(int(timeout / 0.1)):
+            await driver.publish(topic, data, qos=amqtt.mqtt.constants.QOS_1, retain=False)
+            await asyncio.sleep(0.1)
+            if submitted:
+                return
+    finally:
+        await driver.disconnect()
+
+
+def test_command_reaches_queue_after_broker_restart(monkeypatch):
+    submitted = []
+    submit = dispatch.CommandQueue.submit
+
+    def record(queue, topic, data, done=None):
+        submitted.append((queue.device.identifier, topic, data))
+        return submit(queue, topic, data, done)
+
+    monkeypatch.setattr(dispatch.CommandQueue, 'submit', record)
+
+    async def run():
+        port = get_port()
+        server = f'mqtt://127.0.0.1:{port}'
+        sim = simulation.Simulation(connect_delay=0.01, disconnect_delay=0.01)
+        sim.add(simulation.VirtualAM43(ADDRESS))
+        configuration = {
+            'mqtt': {'base_topic': 'test', 'server': server, 'client_id': 'ble2mqtt_test_bridge', 'discovery_cache': None},
+            'controller': {'capacity': 2, 'report_interval': 3600, 'scanner': False, 'snapshot': None},
+            'devices': {ADDRESS: {'type': 'am43'}},
+        }
+        broker = await start_broker(port)
+        bridge = asyncio.create_task(main.serve(configuration, backend=sim.backend))
+        try:
+            identifier = f'am43_{ADDRESS.replace(":", "").lower()}'
+            topic = f'test/{identifier}/set/position'
+            await send_until_submitted(server, topic, b'40', submitted)
+            assert submitted == [(identifier, ['set', 'position'], '40')]
+
+            await stop_broker(broker)
+            broker = await start_broker(port)
+            submitted.clear()
+            await send_until_submitted(server, topic, b'60', submitted)
+            assert submitted == [(identifier, ['set', 'position'], '60')]
+        finally:
+            bridge.cancel()
+            await asyncio.gather(bridge, return_exceptions=True)
+            await stop_broker(broker)
+
+    asyncio.run(run())
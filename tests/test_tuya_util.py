@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from device.tuya import util
+
+
+async def stream(packets):
+    for packet in packets:
+        yield packet
+
+
+def merge(packets):
+    async def collect():
+        return [bytes(message) async for message in util.merge_packets(stream(packets))]
+    return asyncio.run(collect())
+
+
+# 20 is the default write of the minimum ATT MTU, the others are writes of larger negotiated MTUs
+@pytest.mark.parametrize('packet_size', [20, 64, 182, 244, 512])
+# around a length that needs a second varint byte, and one that needs a third
+@pytest.mark.parametrize('length', [1, 127, 128, 129, 16383, 16384, 16385])
+def test_split_merge_roundtrip(packet_size, length):
+    message = bytes(index % 251 for index in range(length))
+    packets = list(util.split_packets(message, packet_size))
+    assert all(len(packet) <= packet_size for packet in packets)
+    assert merge(packets) == [message]
+
+
+@pytest.mark.parametrize('packet_size', [20, 244])
+def test_packet_numbers_past_one_varint_byte(packet_size):
+    message = bytes(index % 251 for index in range(packet_size * 130))
+    packets = list(util.split_packets(message, packet_size))
+    assert len(packets) > 128
+    assert merge(packets) == [message]
+
+
+@pytest.mark.parametrize('packet_size', [20, 244])
+def test_merge_drops_a_message_missing_a_packet(packet_size):
+    first, second = bytes(range(200)) * 3, bytes(range(100))
+    packets = list(util.split_packets(first, packet_size))
+    assert len(packets) > 2
+    del packets[1]
+    assert merge(packets + list(util.split_packets(second, packet_size))) == [second]
+
+
+@pytest.mark.parametrize('value', [0, 127, 128, 16383, 16384, 2 ** 21 - 1, 2 ** 21])
+def test_varint_roundtrip(value):
+    data = util.write_varint(value)
+    assert util.read_varint(b'\x00' + data, 1) == (value, len(data))
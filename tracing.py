@@ -0,0 +1,158 @@
+'''
+Traces of the traffic of a bridge, to replay a production workload offline, see `replay.py`.
+
+`recorder` is off unless the `trace` section of the configuration names a `path`.
+Once on, `bluetooth.Client` records connects, disconnects, errors, GATT writes and notifications,
+`main.serve` records the mqtt messages it receives and the devices it binds, `publish.Outbox` the messages it publishes.
+
+A trace is one json array per line, gzipped if `path` ends with `.gz`.
+The first line is a header, every other line `[seconds since start, kind, *fields]`:
+
+    connect      address
+    disconnect   address, whether the bridge asked for it
+    error        address, repr of the error
+    write        address, characteristic, hex data
+    notify       address, characteristic, hex data
+    bind         identifier, address
+    receive      topic, message
+    publish      topic, message
+'''
+from __future__ import annotations
+
+import collections.abc
+import contextlib
+import gzip
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+def open_file(path: str, mode: str):
+    return gzip.open(path, mode, encoding='utf8') if path.endswith('.gz') else open(path, mode, encoding='utf8')
+
+
+def encode(field):
+    if isinstance(field, (bytes, bytearray, memoryview, tuple)):
+        return bytes(field).hex()
+    return field
+
+
+class Trace:
+
+    def __init__(self):
+        self.file = None
+        self.path: str | None = None
+        self.started = 0.0
+        self.events = 0
+        self.max_events: int | None = None
+
+    def open(self, path: str, base_topic: str, devices: dict[str, dict], max_events: int | None = None):
+        ''' `devices` as in the configuration, only their types are kept '''
+        self.close()
+        self.file = open_file(path, 'wt')
+        self.path = path
+        self.started = time.monotonic()
+        self.events = 0
+        self.max_events = max_events
+        header = {
+            'version': VERSION,
+            'time': time.time(),
+            'base_topic': base_topic,
+            'devices': {address: device_config['type'] for address, device_config in devices.items()},
+        }
+        self.file.write(json.dumps(header, separators=(',', ':')) + '\n')
+        logger.info('tracing.Trace.open recording to %s', path)
+
+    def record(self, kind: str, *fields):
+        ''' does nothing unless recording, bytes-like fields are written as hex '''
+        if not self.file:
+            return
+        if self.max_events is not None and self.events >= self.max_events:
+            logger.warning('tracing.Trace.record stopped after %d events', self.events)
+            self.close()
+            return
+        self.events += 1
+        self.file.write(json.dumps([round(time.monotonic() - self.started, 4), kind, *map(encode, fields)], separators=(',', ':')) + '\n')
+
+    def close(self):
+        if not self.file:
+            return
+        self.file.close()
+        self.file = None
+        logger.info('tracing.Trace.close recorded %d events to %s', self.events, self.path)
+
+
+recorder = Trace()
+
+
+@contextlib.asynccontextmanager
+async def recording(configuration: dict | None, base_topic: str, devices: dict[str, dict] | None):
+    ''' `configuration` is the `trace` section: `path` and `max_events` '''
+    if not configuration or not configuration.get('path'):
+        yield recorder
+        return
+    recorder.open(configuration['path'], base_topic, devices or {}, configuration.get('max_events'))
+    try:
+        yield recorder
+    finally:
+        recorder.close()
+
+
+def read(path: str) -> tuple[dict, list[list]]:
+    ''' the header and events of a trace, a trace cut short by a crash ends at its last whole line '''
+    with open_file(path, 'rt') as file:
+        header = json.loads(file.readline())
+        if header.get('version') != VERSION:
+            raise ValueError(f'{path} is a trace of version {header.get("version")}, expected {VERSION}')
+        events = []
+        try:
+            for line in file:
+                events.append(json.loads(line))
+        except (ValueError, EOFError) as error:
+            logger.warning('tracing.read %s ends early because: %r', path, error)
+    return header, events
+
+
+def percentiles(values: list[float]):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {f'p{q}': values[min(len(values) - 1, int(len(values) * q / 100))] for q in (50, 90, 99)} | {'max': values[-1]}
+
+
+def summarize(header: dict, events: collections.abc.Iterable[list]) -> dict:
+    '''
+    Counts by kind and the latency from an mqtt command to the first GATT write to its device after it,
+    comparable between a trace and its replay.
+    '''
+    base_topic = header['base_topic']
+    counts = collections.Counter()
+    addresses: dict[str, str] = {}
+    # address -> times of the commands not written yet
+    commands: dict[str, list[float]] = collections.defaultdict(list)
+    latencies = []
+    duration = 0.0
+    for at, kind, *fields in events:
+        duration = at
+        counts[kind] += 1
+        if kind == 'bind':
+            identifier, address = fields
+            addresses[identifier] = address
+        elif kind == 'disconnect' and not fields[1]:
+            counts['dropped'] += 1
+        elif kind == 'receive':
+            topic = fields[0].split('/')
+            if topic[0] == base_topic and len(topic) > 2 and topic[1] in addresses and topic[2] in ('set', 'get'):
+                commands[addresses[topic[1]]].append(at)
+        elif kind == 'write' and commands.get(fields[0]):
+            latencies.extend(at - command for command in commands.pop(fields[0]))
+    return {
+        'duration': duration,
+        'events': dict(counts),
+        'unanswered': sum(map(len, commands.values())),
+        'dispatch_latency': percentiles(latencies),
+    }